@@ -0,0 +1,119 @@
+#!/usr/bin/python
+
+""" A generator of synthetic logs for benchmarking """
+
+import argparse
+import datetime
+import pathlib
+import random
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import entry
+import logfile
+
+# words the contents of the entries are made of
+WORDS = ["install", "update", "remove", "config", "kernel", "package", "shell",
+    "editor", "theme", "font", "driver", "network", "backup", "restore", "tweak",
+    "alias", "service", "daemon", "mount", "disk", "cache", "build", "release",
+    "patch", "version", "error", "warning", "fixed", "broken", "slow", "fast"]
+
+# the newest entry of every generated log is made on this date, so that logs
+# generated with the same settings are identical
+LATEST = datetime.date(2020, 1, 1)
+
+DISTRIBUTIONS = ["uniform", "recent", "clustered"]
+
+def build_parser():
+    """ Construct a command line arguments' parser """
+    parser = argparse.ArgumentParser("generate")
+    parser.add_argument("path", help="where to write the log")
+    add_options(parser)
+    return parser
+
+def add_options(parser):
+    """ Add the options describing a synthetic log to a parser """
+    parser.add_argument("-n", "--entries", dest="entries", type=int,
+        default=10000, help="number of entries. Default is 10000.")
+    parser.add_argument("--lines", dest="lines", type=int, default=5,
+        help="average number of lines in an entry. Default is 5.")
+    parser.add_argument("--line-words", dest="line_words", type=int, default=8,
+        help="average number of words in a line. Default is 8.")
+    parser.add_argument("--marks", dest="marks", type=int, default=10,
+        help="number of distinct marks, including no mark. Default is 10.")
+    parser.add_argument("--days", dest="days", type=int, default=None,
+        help="number of days the log spans. Default is enough days for \
+            every mark to be used on a third of them.")
+    parser.add_argument("--dates", dest="dates", choices=DISTRIBUTIONS,
+        default="uniform", help="distribution of the entries' dates: uniform, \
+            skewed towards recent dates, or clustered in bursts. Default is \
+            uniform.")
+    parser.add_argument("--format", dest="version", type=int, choices=[1, 2],
+        default=2, help="format version of the log. Default is 2.")
+    parser.add_argument("--seed", dest="seed", type=int, default=0,
+        help="seed of the random number generator. Default is 0.")
+
+def generate(args):
+    """
+    Return a list of entries of a synthetic log described by parsed options,
+    from the latest to the oldest
+    """
+    rnd = random.Random(args.seed)
+    marks = [""] + [f"mark{i}" for i in range(1, args.marks)]
+    days = args.days or max(1, 3 * args.entries // len(marks))
+    if days * len(marks) < args.entries:
+        raise ValueError(f"{args.entries} entries don't fit into {days} days "
+                f"with {len(marks)} marks.")
+    if args.dates == "clustered":
+        centers = [rnd.randrange(days) for _ in range(max(1, days // 60))]
+    taken = set()
+    entries = []
+    while len(entries) < args.entries:
+        if args.dates == "uniform":
+            age = rnd.randrange(days)
+        elif args.dates == "recent":
+            age = min(days - 1, int(rnd.expovariate(4 / days)))
+        else:
+            age = min(days - 1, abs(int(rnd.gauss(rnd.choice(centers), days / 200 + 1))))
+        date = LATEST - datetime.timedelta(days=age)
+        mark = rnd.choice(marks)
+        if (date, mark) in taken:
+            continue
+        taken.add((date, mark))
+        entries.append(entry.Entry(contents(rnd, args), date, mark))
+    entries.sort(key=lambda e: e.date, reverse=True)
+    return entries
+
+def contents(rnd, args):
+    """ Return random contents of an entry """
+    lines = max(1, int(rnd.expovariate(1 / args.lines)))
+    return "\n".join(
+            " ".join(rnd.choices(WORDS, k=max(1, int(rnd.expovariate(1 / args.line_words)))))
+            for _ in range(lines))
+
+def write(path, entries, version):
+    """
+    Write a log with given entries, converting it to given format version. The
+    entries are written with Entry.to_bytes() in the original format.
+    """
+    path = pathlib.Path(path)
+    with path.open("wb") as f:
+        for e in entries:
+            f.write(e.to_bytes())
+    if version != 1:
+        log = logfile.Logfile(path)
+        log.rewrite(list(log.base_entries()), version)
+
+def main():
+    """ Main """
+    args = build_parser().parse_args()
+    try:
+        entries = generate(args)
+    except ValueError as e:
+        print(e.args[0])
+        sys.exit(1)
+    write(args.path, entries, args.version)
+
+if __name__ == "__main__":
+    main()
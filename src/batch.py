@@ -0,0 +1,140 @@
+""" A module for answering many queries in a single pass over the log """
+
+import argparse
+import datetime
+import shlex
+
+import logger
+
+class Query():
+    """
+    A single query of 'batch' command, with the entries found for it so far.
+    'date' is only set for 'view' queries and 'regex', a search.Pattern, for
+    'grep' and 'grep-marked' ones. 'mark' is None if the query accepts any
+    mark.
+    """
+
+    def __init__(self, text, command, date=None, mark=None, before=None,
+            after=None, regex=None, reverse=False):
+        self.text = text
+        self.command = command
+        self.date = date
+        self.mark = mark
+        self.before = before
+        self.after = after
+        self.regex = regex
+        self.reverse = reverse
+        self.results = []
+
+    def accepts(self, e):
+        """ Return True if the entry answers the query """
+        if self.before is not None and e.date >= self.before:
+            return False
+        if self.after is not None and e.date <= self.after:
+            return False
+        if self.mark is not None and e.mark != self.mark:
+            return False
+        return self.regex is None or self.regex.matches(e.contents)
+
+def answer(log, queries):
+    """
+    Find the entries answering every query. 'view' queries are looked up one
+    by one in the index. The rest share a single pass over the entries made
+    within the widest of their intervals, every entry being handed to every
+    query in turn, so that its contents are decoded at most once.
+    """
+    scanned = []
+    for query in queries:
+        if query.command == "view":
+            found = log.find_specific(query.date, query.mark)
+            query.results = [] if found is None else [found]
+        else:
+            scanned.append(query)
+    if not scanned:
+        return
+    befores = [query.before for query in scanned]
+    afters = [query.after for query in scanned]
+    before = None if None in befores else max(befores)
+    after = None if None in afters else min(afters)
+    marks = {query.mark for query in scanned}
+    mark = marks.pop() if len(marks) == 1 else None
+    for e in log.merged_entries(before, after, mark):
+        for query in scanned:
+            if query.accepts(e):
+                # the results are printed after the lock on the log is
+                # released, when the records may be overwritten in place
+                e.materialize()
+                query.results.append(e)
+
+def parse_query(line, number):
+    """ Return a query described by a line of input of 'batch' command """
+    try:
+        args = QUERY_PARSER.parse_args(shlex.split(line))
+    except (SystemExit, ValueError):
+        print(f"Line {number}: invalid query.")
+        raise logger.ConfigError()
+    dates = {}
+    for name in ["date", "before", "after"]:
+        value = getattr(args, name)
+        if value is not None:
+            dates[name] = logger.parse_date(value)
+            if dates[name] is None:
+                print(f"Line {number}: {logger.INVALID_DATE}")
+                raise logger.ConfigError()
+    regex = None
+    if args.command in ["grep", "grep-marked"]:
+        regex = logger.compile_regex(args.regex, args.fixed_strings,
+                args.ignore_case)
+    if args.command == "view":
+        mark = args.mark
+    elif args.command in ["view-marked", "grep-marked"]:
+        mark = args.marked
+    else:
+        mark = None
+    return Query(line.strip(), args.command,
+            dates.get("date", datetime.date.today()), mark, dates.get("before"),
+            dates.get("after"), regex, args.reverse)
+
+#--------- parser of the queries ---------#
+
+def build_parser():
+    """
+    Construct a parser of the queries, a subset of simlog's own arguments.
+    Unlike simlog's own, the options may also follow the command.
+    """
+    parser = argparse.ArgumentParser("query", add_help=False)
+    add_options(parser, {"mark": "", "date": None, "before": None,
+        "after": None, "reverse": False, "fixed_strings": False,
+        "ignore_case": False})
+    # the options given after the command must not be reset to the defaults
+    options = argparse.ArgumentParser(add_help=False)
+    add_options(options, {name: argparse.SUPPRESS for name in ["mark", "date",
+        "before", "after", "reverse", "fixed_strings", "ignore_case"]})
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("view", add_help=False, parents=[options])
+    subparsers.add_parser("view-all", add_help=False, parents=[options])
+    view_marked_parser = subparsers.add_parser("view-marked", add_help=False,
+            parents=[options])
+    view_marked_parser.add_argument("marked")
+    grep_parser = subparsers.add_parser("grep", add_help=False, parents=[options])
+    grep_parser.add_argument("regex")
+    grep_marked_parser = subparsers.add_parser("grep-marked", add_help=False,
+            parents=[options])
+    grep_marked_parser.add_argument("regex")
+    grep_marked_parser.add_argument("marked")
+    return parser
+
+def add_options(parser, defaults):
+    """ Add the options shared by all the queries to a parser """
+    parser.add_argument("-m", "--mark", dest="mark", default=defaults["mark"])
+    parser.add_argument("-d", "--date", dest="date", default=defaults["date"])
+    parser.add_argument("-b", "--before", dest="before", default=defaults["before"])
+    parser.add_argument("-a", "--after", dest="after", default=defaults["after"])
+    parser.add_argument("-r", "--reverse", dest="reverse", action="store_true",
+            default=defaults["reverse"])
+    parser.add_argument("-F", "--fixed-strings", dest="fixed_strings",
+            action="store_true", default=defaults["fixed_strings"])
+    parser.add_argument("-i", "--ignore-case", dest="ignore_case",
+            action="store_true", default=defaults["ignore_case"])
+
+QUERY_PARSER = build_parser()
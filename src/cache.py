@@ -0,0 +1,130 @@
+""" A module for the persistent cache of query results """
+
+import array
+import struct
+
+import fsutil
+import profiling
+
+# a cache file starts with this signature, followed by a stamp of the log's
+# state, just like the offset index
+MAGIC = b"SIMLOGC1"
+STAMP = struct.Struct("=8sQQ")
+COUNT = struct.Struct("=Q")
+# a cached result header: query's length in bytes and number of offsets,
+# followed by the query and the offsets
+RESULT = struct.Struct("=QQ")
+
+# at most this many results are kept
+CAPACITY = 64
+# and at most this many offsets in all of them
+OFFSETS_CAPACITY = 1 << 18
+
+class QueryCache():
+    """
+    A cache mapping queries to the offsets of the matching entries of the log
+    file, in the log's order. The cache is only valid for the state of the log
+    file it was filled for. Any change of the log file, that is, any
+    compaction, rewrite or record overwritten in place, empties it. The
+    changes kept in the delta log don't affect it: they are merged into the
+    cached results as into any others.
+
+    Queries are strings. The least recently used results are evicted once
+    there are more than CAPACITY of them, or more than OFFSETS_CAPACITY
+    offsets in all of them. Lookups only reorder the results in memory, the
+    order of use is written to disk with the next result cached, so that a
+    search answered from the cache doesn't write anything.
+    """
+
+    def __init__(self, path, capacity=CAPACITY, offsets_capacity=OFFSETS_CAPACITY):
+        self.path = path
+        self.capacity = capacity
+        self.offsets_capacity = offsets_capacity
+        self.stamp = None
+        # query -> offsets, from the least recently used to the most
+        self.results = {}
+
+    #--------- persistence ---------#
+
+    def load(self, stamp):
+        """
+        Load the cache from disk, or start an empty one if there's no cache or
+        if it was filled for a different state of the log
+        """
+        if self.stamp == stamp:
+            return
+        self.results, self.stamp = {}, stamp
+        try:
+            with self.path.open("rb") as f:
+                data = f.read()
+            profiling.count("bytes read", len(data))
+        except FileNotFoundError:
+            return
+        head_size = STAMP.size + COUNT.size
+        if len(data) < head_size or STAMP.unpack_from(data, 0) != (MAGIC, *stamp):
+            return
+        count, = COUNT.unpack_from(data, STAMP.size)
+        pos = head_size
+        results = {}
+        try:
+            for _ in range(count):
+                key_len, n = RESULT.unpack_from(data, pos)
+                pos += RESULT.size
+                query = data[pos : pos + key_len].decode("utf-8")
+                pos += key_len
+                offsets = array.array("Q")
+                offsets.frombytes(data[pos : pos + n * offsets.itemsize])
+                pos += n * offsets.itemsize
+                results[query] = offsets
+        except (struct.error, UnicodeDecodeError, ValueError):
+            return
+        self.results = results
+
+    def save(self):
+        """ Write the cache to disk """
+        chunks = [STAMP.pack(MAGIC, *self.stamp), COUNT.pack(len(self.results))]
+        for query, offsets in self.results.items():
+            key = bytes(query, "utf-8")
+            chunks.append(RESULT.pack(len(key), len(offsets)))
+            chunks.append(key)
+            chunks.append(offsets.tobytes())
+        data = b"".join(chunks)
+        fsutil.replace_file(self.path, lambda f: f.write(data), sync=False)
+
+    def clear(self, stamp):
+        """
+        Drop all the results, as the entries of the log file were changed in
+        place, and start an empty cache for given state of the log
+        """
+        self.results, self.stamp = {}, stamp
+        if self.path.exists():
+            self.path.unlink()
+
+    #--------- lookup ---------#
+
+    def get(self, query, stamp):
+        """
+        Return the cached offsets of the entries matching a query, or None if
+        the query's result for given state of the log isn't cached
+        """
+        self.load(stamp)
+        offsets = self.results.get(query)
+        if offsets is None:
+            profiling.count("cache misses")
+            return None
+        profiling.count("cache hits")
+        del self.results[query]
+        self.results[query] = offsets
+        return offsets
+
+    def put(self, query, stamp, offsets):
+        """ Cache the offsets of the entries matching a query """
+        self.load(stamp)
+        self.results.pop(query, None)
+        self.results[query] = array.array("Q", offsets)
+        total = sum(map(len, self.results.values()))
+        while (len(self.results) > self.capacity
+                or total > self.offsets_capacity) and self.results:
+            oldest = next(iter(self.results))
+            total -= len(self.results.pop(oldest))
+        self.save()
@@ -0,0 +1,110 @@
+""" A module for the append-only delta log kept alongside the log file """
+
+import os
+
+import entry
+import profiling
+
+# every record in the delta log is an entry prefixed with one of these
+PUT = b"\x01"
+DELETE = b"\x00"
+
+class Delta():
+    """
+    An append-only log of changes to the main log file.
+
+    Added and edited entries are appended as PUT records, removed entries as
+    DELETE records (tombstones). A later record for the same date and mark
+    overrides an earlier one. The changes are merged into the main log by
+    compaction.
+
+    An entry added again after it was removed is a new entry rather than a
+    change of the old one, and the delta log keeps the keys of such entries
+    apart.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.overrides = {}
+        # (date, mark) pairs of the entries removed and then added again
+        self.readded = set()
+        self.records = 0
+        self.valid_size = 0
+
+    def load(self):
+        """
+        Return a dict mapping (date, mark) pairs of the changed entries to their
+        new versions, or to None if the entry was removed.
+        """
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            self.stamp, self.overrides, self.records = None, {}, 0
+            self.readded, self.valid_size = set(), 0
+            return self.overrides
+        stamp = st.st_size, st.st_mtime_ns
+        if stamp == self.stamp:
+            return self.overrides
+        overrides = {}
+        readded = set()
+        records = 0
+        valid_size = 0
+        with self.path.open("rb") as f:
+            while True:
+                op = f.read(1)
+                if op not in (PUT, DELETE):
+                    break
+                try:
+                    e = entry.Entry.from_binary_file(f)
+                except (entry.EntryReadError, UnicodeDecodeError, ValueError):
+                    break
+                key = (e.date, e.mark)
+                if op == PUT and key in overrides and overrides[key] is None:
+                    # the entry is added anew, after the ones added since it
+                    # was removed
+                    del overrides[key]
+                    readded.add(key)
+                overrides[key] = e if op == PUT else None
+                records += 1
+                valid_size = f.tell()
+        self.stamp, self.overrides, self.records = stamp, overrides, records
+        self.readded, self.valid_size = readded, valid_size
+        profiling.count("bytes read", st.st_size)
+        return overrides
+
+    def append(self, changes, sync=True):
+        """
+        Append a list of (op, entry) pairs to the delta log. A torn record left
+        at the end of the log by an interrupted append is cut off first. If
+        'sync' is True, the new records are flushed to disk.
+        """
+        self.load()
+        data = b"".join(op + e.to_bytes() for op, e in changes)
+        with self.path.open("ab") as f:
+            if f.tell() > self.valid_size:
+                f.truncate(self.valid_size)
+            f.write(data)
+            profiling.count("bytes written", len(data))
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def truncate(self, size):
+        """
+        Drop the records appended after the delta log was given number of bytes
+        long
+        """
+        if size == 0:
+            self.clear()
+            return
+        with self.path.open("r+b") as f:
+            f.truncate(size)
+        self.stamp = None
+
+    def clear(self):
+        """ Drop all the changes, presumably after they were compacted """
+        if self.path.exists():
+            self.path.unlink()
+        self.stamp, self.overrides, self.records = None, {}, 0
+        self.readded, self.valid_size = set(), 0
@@ -1,7 +1,10 @@
 """ A module for log entries' representation """
 
 import datetime
-import sys
+import functools
+import struct
+
+import profiling
 
 # a number of constants controlling the structure of entries' headers
 YEAR_SIZE = 4
@@ -18,9 +21,15 @@ MARK_LENGTH_OFFSET = LENGTH_OFFSET + LENGTH_SIZE
 
 HEADER_SIZE = MARK_LENGTH_OFFSET + MARK_LENGTH_SIZE
 
+# the whole header as a single structure: year, month, day, length and mark
+# length, in native byte order
+HEADER = struct.Struct("=IIIQQ")
+
 class Entry():
     """ A representation of a log entry """
 
+    __slots__ = ("contents", "date", "mark")
+
     def __init__(self, contents, date, mark):
         self.mark = mark
         self.date = date
@@ -37,30 +46,26 @@ class Entry():
 
     def format(self, no_date=False, no_mark=False, no_end=False):
         """ Format entry for printing """
-        res = ""
+        parts = []
         if not no_date:
-            date = self.date.strftime("%Y %b %d, %A")
-            res += f"-- {date} --\n"
+            parts.append(date_header(self.date))
         if not no_mark:
-            mark = "Not marked" if self.mark == "" else f"Marked: {self.mark}"
-            res += f"-- {mark} --\n"
-        res += f"{self.contents.strip()}"
+            parts.append(mark_header(self.mark))
+        parts.append(self.contents.strip())
         if not no_end:
-            res += "\n-- end --\n"
-        return res
+            parts.append("\n-- end --\n")
+        return "".join(parts)
 
     def to_bytes(self):
         """ Convert an entry to a bytestring """
-        mark_len = len(self.mark)
+        mark = bytes(self.mark, "utf-8")
         cont = bytes(self.contents, "utf-8")
-        length = len(cont)
-        header = self.date.year.to_bytes(YEAR_SIZE, byteorder=sys.byteorder) \
-            + self.date.month.to_bytes(MONTH_SIZE, byteorder=sys.byteorder) \
-            + self.date.day.to_bytes(DAY_SIZE, byteorder=sys.byteorder) \
-            + length.to_bytes(LENGTH_SIZE, byteorder=sys.byteorder) \
-            + mark_len.to_bytes(MARK_LENGTH_SIZE, byteorder=sys.byteorder) \
-            + bytes(self.mark, "utf-8")
-        return header + cont
+        header = HEADER.pack(self.date.year, self.date.month, self.date.day,
+                len(cont), len(mark))
+        return header + mark + cont
+
+    def materialize(self):
+        """ Do nothing: the fields of a plain entry are decoded already """
 
     def match(self, other):
         """
@@ -87,18 +92,10 @@ class Entry():
         header = from_file.read(HEADER_SIZE)
         if len(header) < HEADER_SIZE:
             raise EntryReadError()
-        year = (int).from_bytes(header[YEAR_OFFSET : YEAR_OFFSET + YEAR_SIZE],
-                sys.byteorder)
-        month = (int).from_bytes(header[MONTH_OFFSET : MONTH_OFFSET + MONTH_SIZE],
-                sys.byteorder)
-        day = (int).from_bytes(header[DAY_OFFSET : DAY_OFFSET + DAY_SIZE],
-                sys.byteorder)
-        length = (int).from_bytes(header[LENGTH_OFFSET : LENGTH_OFFSET + LENGTH_SIZE],
-                sys.byteorder)
-        mark_len = (int).from_bytes(header[
-            MARK_LENGTH_OFFSET : MARK_LENGTH_OFFSET + MARK_LENGTH_SIZE],
-            sys.byteorder)
+        year, month, day, length, mark_len = HEADER.unpack(header)
         rest = from_file.read(length + mark_len)
+        if len(rest) < length + mark_len:
+            raise EntryReadError()
         mark = rest[:mark_len].decode("utf-8")
         contents = rest[mark_len:mark_len + length].decode("utf-8")
         return Entry(contents, datetime.date(year, month, day), mark)
@@ -114,6 +111,93 @@ class Entry():
             cont = f.read()
             return Entry(cont, date, mark)
 
+class EntryView(Entry):
+    """
+    An entry of the log file decoded lazily, on first access to its fields.
+
+    The view holds the undecoded date key, the offset of the record and the
+    location of the contents in a buffer with the log, along with the layout
+    of the log. The contents are
+    decoded and the date is built only when they are needed, so the entries
+    that are only filtered by their marks and dates never decode them. Views
+    of the same layout are compared by their date keys.
+    """
+
+    __slots__ = ("buf", "layout", "offset", "key", "cont_at", "end", "extra",
+            "_contents", "_date")
+
+    def __init__(self, buf, layout, offset, key, mark, cont_at, end, extra):
+        self.buf = buf
+        self.layout = layout
+        self.offset = offset
+        self.key = key
+        self.mark = mark
+        self.cont_at = cont_at
+        self.end = end
+        self.extra = extra
+        self._contents = None
+        self._date = None
+
+    @property
+    def contents(self):
+        """ The contents of the entry, decoded on first access """
+        if self._contents is None:
+            with memoryview(self.buf) as buf:
+                self._contents = self.layout.contents(buf, self.cont_at, self.end,
+                        self.extra)
+            # the buffer is no longer needed, and it may be a whole mapped log
+            self.buf = None
+            profiling.count("entries decoded")
+        return self._contents
+
+    @contents.setter
+    def contents(self, value):
+        self._contents = value
+        self.buf = None
+
+    @property
+    def date(self):
+        """ The date of the entry, built on first access """
+        if self._date is None:
+            self._date = self.layout.date(self.key)
+        return self._date
+
+    def materialize(self):
+        """ Decode all the fields right away, releasing the buffer """
+        self.contents
+        self.date
+
+    def __lt__(self, other):
+        if isinstance(other, EntryView) and type(other.layout) is type(self.layout):
+            return self.key < other.key
+        return self.date < other.date
+
+    def __gt__(self, other):
+        if isinstance(other, EntryView) and type(other.layout) is type(self.layout):
+            return self.key > other.key
+        return self.date > other.date
+
+    def __eq__(self, other):
+        if isinstance(other, EntryView) and type(other.layout) is type(self.layout):
+            return self.key == other.key
+        return self.date == other.date
+
+#--------- helper functions ---------#
+
+@functools.lru_cache(maxsize=4096)
+def date_header(date):
+    """ Return the date header line of an entry made on given date """
+    date = date.strftime("%Y %b %d, %A")
+    return f"-- {date} --\n"
+
+@functools.lru_cache(maxsize=1024)
+def mark_header(mark):
+    """ Return the mark header line of an entry with given mark """
+    mark = "Not marked" if mark == "" else f"Marked: {mark}"
+    return f"-- {mark} --\n"
+
+#--------- errors ---------#
+
 class EntryReadError(Exception):
     """
     An error of this type will be raised when an entry read from a binary file
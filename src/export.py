@@ -0,0 +1,102 @@
+""" A module for exporting the entries into formats other tools can read """
+
+import os
+
+import fsutil
+
+# formats entries can be exported to
+FORMATS = ["jsonl", "csv", "sqlite"]
+
+# rows written to an SQLite database in a single transaction
+BATCH = 1000
+
+SCHEMA = [
+    """CREATE TABLE entries (
+        date TEXT NOT NULL,
+        mark TEXT NOT NULL,
+        contents TEXT NOT NULL,
+        PRIMARY KEY (date, mark))""",
+]
+INDICES = [
+    "CREATE INDEX entries_by_mark ON entries (mark, date)",
+]
+FULL_TEXT = [
+    """CREATE VIRTUAL TABLE entries_fts USING fts5(contents,
+        content='entries', content_rowid='rowid')""",
+    "INSERT INTO entries_fts (entries_fts) VALUES ('rebuild')",
+]
+
+def write_jsonl(entries, stream):
+    """
+    Write entries as JSON objects with 'date', 'mark' and 'contents' fields,
+    one per line, as 'import' command reads them
+    """
+    import json
+    for e in entries:
+        record = {"date": e.date.isoformat(), "mark": e.mark, "contents": e.contents}
+        stream.write(json.dumps(record, ensure_ascii=False))
+        stream.write("\n")
+
+def write_csv(entries, stream):
+    """ Write entries as CSV with a header and date, mark and contents columns """
+    import csv
+    writer = csv.writer(stream)
+    writer.writerow(["date", "mark", "contents"])
+    for e in entries:
+        writer.writerow([e.date.isoformat(), e.mark, e.contents])
+
+def write_sqlite(entries, path):
+    """
+    Write entries into a new SQLite database at given path, replacing the
+    file if it exists. The rows are inserted in transactions of BATCH rows,
+    then the index on marks and the full-text index of the contents are
+    built in one pass each. Return False if the full-text index couldn't be
+    built because SQLite lacks FTS5.
+
+    The database is built in a temporary file and moved in place once it is
+    complete.
+    """
+    import sqlite3
+    tmp = fsutil.temp_path(path)
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        db = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            # the file is thrown away if anything goes wrong
+            db.execute("PRAGMA journal_mode = OFF")
+            db.execute("PRAGMA synchronous = OFF")
+            for statement in SCHEMA:
+                db.execute(statement)
+            rows = []
+            for e in entries:
+                rows.append((e.date.isoformat(), e.mark, e.contents))
+                if len(rows) >= BATCH:
+                    insert(db, rows)
+                    rows.clear()
+            insert(db, rows)
+            for statement in INDICES:
+                db.execute(statement)
+            full_text = True
+            try:
+                for statement in FULL_TEXT:
+                    db.execute(statement)
+            except sqlite3.OperationalError:
+                full_text = False
+        finally:
+            db.close()
+        os.replace(tmp, path)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    return full_text
+
+#--------- helper functions ---------#
+
+def insert(db, rows):
+    """ Insert a batch of rows in a single transaction """
+    db.execute("BEGIN")
+    db.executemany("INSERT INTO entries (date, mark, contents) VALUES (?, ?, ?)",
+            rows)
+    db.execute("COMMIT")
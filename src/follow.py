@@ -0,0 +1,265 @@
+""" A module for following the changes of the log as they happen """
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+import entry
+import formats
+
+# inotify(7) constants
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+# an inotify event's header: watch descriptor, mask, cookie and name's length
+EVENT = struct.Struct("iIII")
+
+# with inotify, the files are checked at least this often anyway, in seconds
+CHECK_INTERVAL = 5.0
+
+class Follower():
+    """
+    A tracker of the entries added or changed since it was last asked. Every
+    segment of the log, that is, the log file or every shard of a sharded
+    log, is tracked separately.
+    """
+
+    def __init__(self, log, mark=None, pattern=None):
+        self.log = log
+        self.mark = mark
+        self.pattern = pattern
+        # trackers of the segments by their paths
+        self.segments = {}
+        self.refresh()
+
+    def changes(self):
+        """
+        Return a list of the entries added or changed since the last call,
+        from the oldest to the latest
+        """
+        return sorted(self.refresh(), key=lambda e: e.date)
+
+    def refresh(self):
+        """ Return a list of the changed entries passing the filters """
+        changed = []
+        with self.log.lock.held():
+            for log in self.log.segments():
+                segment = self.segments.get(log.path)
+                if segment is None:
+                    # logs numbering their changes are simply asked for the
+                    # changes since the last one seen
+                    track = Sequence if hasattr(log, "changes_since") else Segment
+                    segment = self.segments[log.path] = track(log, self.mark)
+                changed.extend(e for e in segment.refresh() if self.pattern is None
+                        or self.pattern.matches(e.contents))
+        return changed
+
+class Segment():
+    """
+    A tracker of the changes of a single log file with its delta log.
+
+    The state of the log is identified by the stamps of the log file and of
+    the delta log. As long as only the delta log changes, which is the case
+    for everything but compactions, imports and in-place edits, only the
+    entries mentioned in the delta log are compared, and the log file isn't
+    read at all. When the log file changes, the records are compared by their
+    fingerprints first, so only the records that were actually changed are
+    decoded. In the latest layout the fingerprint is read from the record's
+    header, so unchanged records are neither copied nor hashed.
+    """
+
+    def __init__(self, log, mark=None):
+        self.log = log
+        self.mark = mark
+        # (date, mark) -> (fingerprint of the record, signature of the
+        # contents) for the entries in the log file
+        self.base = {}
+        self.base_stamp = None
+        self.delta_stamp = None
+        self.overrides = {}
+        # (date, mark) -> signature of the contents, for all the entries
+        self.known = {}
+
+    def refresh(self):
+        """
+        Bring the signatures up to date with the log. Return a list of the
+        changed entries with the mark asked for.
+        """
+        with self.log.lock.held():
+            entries = {}
+            keys = set()
+            base_stamp = self.log.stamp()
+            if base_stamp != self.base_stamp:
+                entries = self.read_base()
+                self.base_stamp = base_stamp
+                keys = entries.keys() | self.known.keys()
+            overrides = self.log.delta.load()
+            if self.log.delta.stamp != self.delta_stamp:
+                keys |= overrides.keys() | self.overrides.keys()
+                self.overrides = dict(overrides)
+                self.delta_stamp = self.log.delta.stamp
+            changed = []
+            for key in keys:
+                if self.mark is not None and key[1] != self.mark:
+                    continue
+                if key in overrides:
+                    e = overrides[key]
+                    sig = None if e is None else signature(e)
+                else:
+                    e = entries.get(key)
+                    sig = self.base[key][1] if key in self.base else None
+                if sig is None:
+                    self.known.pop(key, None)
+                    continue
+                if self.known.get(key) == sig:
+                    continue
+                self.known[key] = sig
+                if e is None:
+                    e = self.log.find_specific(*key)
+                changed.append(e)
+            return changed
+
+    def read_base(self):
+        """
+        Update the signatures of the entries of the log file. Return a dict
+        with the entries that had to be decoded, by their dates and marks.
+        """
+        base = {}
+        decoded = {}
+        with self.log.mapped() as mm:
+            layout = formats.detect(mm)
+            for offset, key, mark, cont_at, end, extra in layout.walk(mm):
+                if self.mark is not None and mark != self.mark:
+                    continue
+                raw = layout.fingerprint(mm, offset, end, extra)
+                date = layout.date(key)
+                old = self.base.get((date, mark))
+                if old is not None and old[0] == raw:
+                    base[(date, mark)] = old
+                    continue
+                e = entry.EntryView(mm, layout, offset, key, mark, cont_at, end, extra)
+                e.materialize()
+                base[(date, mark)] = raw, signature(e)
+                decoded[(date, mark)] = e
+        self.base = base
+        return decoded
+
+class Sequence():
+    """
+    A tracker of the changes of a log numbering them, such as SqliteLog. The
+    numbers only grow, and removals take them too, so a removal alone moves
+    the tracker past it, and the changes after it are never mistaken for
+    ones already seen.
+    """
+
+    def __init__(self, log, mark=None):
+        self.log = log
+        self.mark = mark
+        # the number of the latest change seen
+        self.seq = 0
+
+    def refresh(self):
+        """ Return a list of the entries changed since the last call """
+        changed, self.seq = self.log.changes_since(self.seq, self.mark)
+        return changed
+
+class Watcher():
+    """
+    A waiter for changes of some files in a directory, using inotify where
+    available and polling the files' stamps otherwise
+    """
+
+    def __init__(self, directory, names, interval=1.0):
+        self.directory = directory
+        self.names = set(names)
+        self.interval = interval
+        self.fd = inotify_watch(directory)
+        self.stamps = self.poll()
+
+    def wait(self):
+        """ Block until one of the files may have changed """
+        if self.fd is not None:
+            # events for other files, such as the lock file and the sidecar
+            # files touched by reading the log, don't end the wait
+            while True:
+                ready, _, _ = select.select([self.fd], [], [], CHECK_INTERVAL)
+                if not ready or self.relevant(self.read_events()):
+                    return
+        else:
+            select.select([], [], [], self.interval)
+        while self.fd is None:
+            stamps = self.poll()
+            if stamps != self.stamps:
+                self.stamps = stamps
+                return
+            select.select([], [], [], self.interval)
+
+    def read_events(self):
+        """ Return the pending inotify events, possibly none """
+        try:
+            return os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return b""
+
+    def relevant(self, events):
+        """ Return whether a batch of inotify events concerns watched files """
+        pos = 0
+        while pos + EVENT.size <= len(events):
+            _, _, _, length = EVENT.unpack_from(events, pos)
+            pos += EVENT.size
+            name = events[pos : pos + length].rstrip(b"\0")
+            pos += length
+            if os.fsdecode(name) in self.names:
+                return True
+        return False
+
+    def poll(self):
+        """ Return the stamps of the watched files """
+        stamps = []
+        for name in sorted(self.names):
+            try:
+                st = os.stat(self.directory / name)
+                stamps.append((st.st_ino, st.st_size, st.st_mtime_ns))
+            except FileNotFoundError:
+                stamps.append(None)
+        return stamps
+
+    def close(self):
+        """ Stop watching """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+#--------- helper functions ---------#
+
+def signature(e):
+    """ Return a value changing whenever the contents of an entry change """
+    return hash(e.contents)
+
+def inotify_watch(directory):
+    """
+    Return an inotify descriptor watching for changes of the files in given
+    directory, or None if inotify is not available
+    """
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    fd = init(IN_CLOEXEC | IN_NONBLOCK)
+    if fd < 0:
+        return None
+    mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    if add_watch(fd, os.fsencode(directory), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
@@ -0,0 +1,251 @@
+""" A module describing the on-disk layouts of the log file """
+
+import datetime
+import struct
+import zlib
+
+import entry
+
+#--------- version 2 layout's structure ---------#
+
+# a version 2 log starts with the signature, flags (currently unused), and
+# the number of marks in the mark table, followed by the table itself: every
+# mark is stored once, as its length and its UTF-8 bytes.
+MAGIC = b"SIMLOGv2"
+FILE_HEADER = struct.Struct("<8sII")
+MARK_LENGTH = struct.Struct("<I")
+# every record consists of a header of the date's ordinal, the mark's number
+# in the mark table, the payload's length, the CRC-32 of the record and
+# record's flags, followed by the payload
+RECORD = struct.Struct("<IIIIB")
+# the part of the header covered by the CRC together with the payload
+RECORD_KEY = struct.Struct("<IIB")
+
+# record flags
+COMPRESSED = 0x01
+
+# contents shorter than this are never compressed
+COMPRESS_MIN = 256
+
+#--------- layouts ---------#
+
+class V1():
+    """
+    The original layout: a bare sequence of entries, each with a fixed header
+    of native-endian integers and the mark stored in full. Dates are keyed by
+    (year, month, day) tuples.
+    """
+
+    version = 1
+    start = 0
+
+    @staticmethod
+    def key(date):
+        """ Return a comparable key of a date, as used by walk() """
+        return date.year, date.month, date.day
+
+    @staticmethod
+    def date(key):
+        """ Convert a key back into a date """
+        return datetime.date(*key)
+
+    def walk(self, buf, pos=0):
+        """
+        Return an iterator over the records in a buffer, starting at given
+        offset. Yield tuples of the record's offset, its date key, its mark,
+        the offsets of its contents and its end, and a value to be passed to
+        contents().
+        """
+        unpack = entry.HEADER.unpack_from
+        size = len(buf)
+        pos = max(pos, self.start)
+        while pos + entry.HEADER_SIZE <= size:
+            year, month, day, length, mark_len = unpack(buf, pos)
+            mark_at = pos + entry.HEADER_SIZE
+            cont_at = mark_at + mark_len
+            end = cont_at + length
+            if end > size:
+                return
+            yield (pos, (year, month, day), str(buf[mark_at:cont_at], "utf-8"),
+                    cont_at, end, None)
+            pos = end
+
+    def contents(self, buf, cont_at, end, extra):
+        """ Decode contents of a record found by walk() """
+        return str(buf[cont_at:end], "utf-8")
+
+    def fingerprint(self, buf, offset, end, extra):
+        """
+        Return a value changing whenever the bytes of a record found by walk()
+        change. There's nothing to go by but the bytes themselves here.
+        """
+        return hash(buf[offset:end])
+
+    def read_entry(self, buf, offset):
+        """
+        Return a lazily decoded entry starting at given offset of a buffer
+        """
+        for _, key, mark, cont_at, end, extra in self.walk(buf, offset):
+            return entry.EntryView(buf, self, offset, key, mark, cont_at, end, extra)
+        raise entry.EntryReadError()
+
+    def pack(self, e, compress=False):
+        """ Return the bytes of a record for an entry """
+        return e.to_bytes()
+
+    def dump(self, f, entries, compress=False):
+        """
+        Write a list of entries to a file in this layout. Return a list of the
+        entries' offsets.
+        """
+        offsets = []
+        for e in entries:
+            offsets.append(f.tell())
+            f.write(e.to_bytes())
+        return offsets
+
+class V2():
+    """
+    A portable layout: fixed little-endian headers, dates stored as day
+    ordinals, marks stored once in a table in the head of the file, a CRC-32
+    for every record and optional zlib compression of the contents. Dates are
+    keyed by their ordinals.
+    """
+
+    version = 2
+
+    def __init__(self, marks=(), start=0):
+        self.marks = list(marks)
+        self.start = start
+
+    @classmethod
+    def parse(cls, buf):
+        """ Read the file header and the mark table from a buffer """
+        _, flags, count = FILE_HEADER.unpack_from(buf, 0)
+        pos = FILE_HEADER.size
+        marks = []
+        for _ in range(count):
+            length, = MARK_LENGTH.unpack_from(buf, pos)
+            pos += MARK_LENGTH.size
+            marks.append(str(buf[pos : pos + length], "utf-8"))
+            pos += length
+        return cls(marks, pos)
+
+    @staticmethod
+    def key(date):
+        """ Return a comparable key of a date, as used by walk() """
+        return date.toordinal()
+
+    @staticmethod
+    def date(key):
+        """ Convert a key back into a date """
+        return datetime.date.fromordinal(key)
+
+    def walk(self, buf, pos=0):
+        """
+        Return an iterator over the records in a buffer, starting at given
+        offset. Yield tuples of the record's offset, its date key, its mark,
+        the offsets of its contents and its end, and a value to be passed to
+        contents().
+        """
+        unpack = RECORD.unpack_from
+        marks = self.marks
+        size = len(buf)
+        pos = max(pos, self.start)
+        while pos + RECORD.size <= size:
+            header = unpack(buf, pos)
+            ordinal, mark_id, length = header[:3]
+            cont_at = pos + RECORD.size
+            end = cont_at + length
+            if end > size or mark_id >= len(marks):
+                return
+            yield pos, ordinal, marks[mark_id], cont_at, end, header
+            pos = end
+
+    def contents(self, buf, cont_at, end, header):
+        """
+        Decode contents of a record found by walk(), checking the record's CRC
+        """
+        # slices of the buffer are never bound to names, so that no reference
+        # to the buffer outlives this call even if it raises
+        ordinal, mark_id, _, crc, flags = header
+        key = zlib.crc32(RECORD_KEY.pack(ordinal, mark_id, flags))
+        if zlib.crc32(buf[cont_at:end], key) != crc:
+            raise entry.EntryReadError(f"Checksum mismatch in the record at offset "
+                    f"{cont_at - RECORD.size}.")
+        if flags & COMPRESSED:
+            return str(zlib.decompress(buf[cont_at:end]), "utf-8")
+        return str(buf[cont_at:end], "utf-8")
+
+    def fingerprint(self, buf, offset, end, header):
+        """
+        Return a value changing whenever the bytes of a record found by walk()
+        change, taken from its header: the length, the CRC and the flags
+        """
+        return header[2:]
+
+    def read_entry(self, buf, offset):
+        """
+        Return a lazily decoded entry starting at given offset of a buffer
+        """
+        for _, key, mark, cont_at, end, extra in self.walk(buf, offset):
+            return entry.EntryView(buf, self, offset, key, mark, cont_at, end, extra)
+        raise entry.EntryReadError()
+
+    def dump(self, f, entries, compress=False):
+        """
+        Write a list of entries to a file in this layout, compressing long
+        contents if 'compress' is True. Return a list of the entries' offsets.
+        """
+        ids = {}
+        for e in entries:
+            ids.setdefault(e.mark, len(ids))
+        self.marks = list(ids)
+        chunks = [FILE_HEADER.pack(MAGIC, 0, len(self.marks))]
+        for mark in self.marks:
+            mark = bytes(mark, "utf-8")
+            chunks.append(MARK_LENGTH.pack(len(mark)))
+            chunks.append(mark)
+        f.write(b"".join(chunks))
+        self.start = f.tell()
+        offsets = []
+        for e in entries:
+            offsets.append(f.tell())
+            f.write(self.encode(e, ids[e.mark], compress))
+        return offsets
+
+    def pack(self, e, compress=False):
+        """
+        Return the bytes of a record for an entry, whose mark must be in the
+        mark table
+        """
+        return self.encode(e, self.marks.index(e.mark), compress)
+
+    @staticmethod
+    def encode(e, mark_id, compress=False):
+        """ Return the bytes of a record for an entry """
+        payload = bytes(e.contents, "utf-8")
+        flags = 0
+        if compress and len(payload) >= COMPRESS_MIN:
+            packed = zlib.compress(payload)
+            if len(packed) < len(payload):
+                payload, flags = packed, COMPRESSED
+        ordinal = e.date.toordinal()
+        crc = zlib.crc32(payload, zlib.crc32(RECORD_KEY.pack(ordinal, mark_id, flags)))
+        return RECORD.pack(ordinal, mark_id, len(payload), crc, flags) + payload
+
+#--------- helper functions ---------#
+
+def detect(buf):
+    """
+    Return the layout of the log held in a buffer. Empty logs are reported as
+    version 2.
+    """
+    if len(buf) == 0:
+        return V2()
+    if len(buf) >= FILE_HEADER.size and buf[:len(MAGIC)] == MAGIC:
+        return V2.parse(buf)
+    return V1()
+
+# layouts by their version numbers
+LAYOUTS = {1: V1, 2: V2}
@@ -0,0 +1,84 @@
+""" A module with helpers for crash-safe file updates """
+
+import os
+
+import profiling
+
+# suffix of temporary files holding new versions of files being replaced
+TEMP_SUFFIX = ".tmp"
+
+def replace_file(path, write, sync=True):
+    """
+    Write a new version of a file into a temporary file with write(file) and
+    atomically move it in place of the old one, so that a crash leaves either
+    the old or the new version intact. If 'sync' is True, the data and the
+    rename are flushed to disk before returning. Return what write(file)
+    returned.
+    """
+    tmp = temp_path(path)
+    try:
+        with tmp.open("wb") as f:
+            result = write(f)
+            profiling.count("bytes written", f.tell())
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if tmp.exists():
+            tmp.unlink()
+        raise
+    if sync:
+        sync_dir(path.parent)
+    return result
+
+def patch_head(path, old, new):
+    """
+    Overwrite the head of a file with new bytes of the same length, if the
+    file starts with given old bytes. Return whether the file was patched.
+    """
+    try:
+        with path.open("r+b") as f:
+            if f.read(len(old)) != old:
+                return False
+            f.seek(0)
+            f.write(new)
+    except FileNotFoundError:
+        return False
+    return True
+
+def advance_mtime(path, mtime_ns):
+    """
+    Make sure the modification time of a file is later than given one, in
+    nanoseconds, for file systems storing coarse times. Return the file's
+    new stat result.
+    """
+    st = os.stat(path)
+    step = 1
+    # the time is moved forward by ever larger steps, up to two seconds, the
+    # coarsest resolution there is
+    while st.st_mtime_ns <= mtime_ns and step <= 2 * 10**9:
+        os.utime(path, ns=(st.st_atime_ns, mtime_ns + step))
+        st = os.stat(path)
+        step *= 10
+    return st
+
+def temp_path(path):
+    """
+    Return the path of the temporary file used by this process to replace
+    given file
+    """
+    return path.with_name(f"{path.name}.{os.getpid()}{TEMP_SUFFIX}")
+
+def sync_dir(path):
+    """ Flush the directory entries of given directory to disk """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
@@ -0,0 +1,209 @@
+""" A module for the sidecar offset index of the log file """
+
+import bisect
+import struct
+
+import fsutil
+import profiling
+
+# an index file starts with this signature, followed by a stamp identifying
+# the state of the log the index was built for: log's size and modification
+# time in nanoseconds
+MAGIC = b"SIMLOGI2"
+STAMP = struct.Struct("=8sQQ")
+COUNT = struct.Struct("=Q")
+# a skip table record: date's ordinal and entry's offset
+SKIP = struct.Struct("=IQ")
+# an index record: date's ordinal, entry's offset and mark's length, followed
+# by the mark itself
+RECORD = struct.Struct("=IQQ")
+
+# every SKIP_INTERVAL-th entry of the log gets a record in the skip table
+SKIP_INTERVAL = 64
+
+class Index():
+    """
+    An index mapping dates and marks of the entries to their offsets in the log
+    file.
+
+    The records are kept in the same order as the entries in the log, that is,
+    from the latest to the oldest. Dates are stored as negated ordinals, so
+    that the list of keys is sorted in ascending order and can be bisected.
+
+    Besides the full list of records, the index holds a sparse skip table with
+    every SKIP_INTERVAL-th record. It is stored in the head of the index file,
+    so date range queries can load it without parsing the whole index.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.keys = []
+        self.marks = []
+        self.offsets = []
+        self.skip_stamp = None
+        self.skip_keys = []
+        self.skip_offsets = []
+
+    #--------- persistence ---------#
+
+    def load(self, stamp):
+        """
+        Load the index from disk. Return False if there's no index or if it
+        was built for a different state of the log.
+        """
+        if self.stamp == stamp:
+            return True
+        try:
+            with self.path.open("rb") as f:
+                data = f.read()
+            profiling.count("bytes read", len(data))
+        except FileNotFoundError:
+            return False
+        pos = self.parse_skips(data, stamp)
+        if pos is None:
+            return False
+        count, = COUNT.unpack_from(data, STAMP.size)
+        keys, marks, offsets = [], [], []
+        try:
+            for _ in range(count):
+                ordinal, offset, mark_len = RECORD.unpack_from(data, pos)
+                pos += RECORD.size
+                keys.append(-ordinal)
+                marks.append(data[pos : pos + mark_len].decode("utf-8"))
+                offsets.append(offset)
+                pos += mark_len
+        except (struct.error, UnicodeDecodeError):
+            return False
+        self.keys, self.marks, self.offsets = keys, marks, offsets
+        self.stamp = stamp
+        return True
+
+    def load_skips(self, stamp):
+        """
+        Load just the skip table from disk. Return False if there's no index
+        or if it was built for a different state of the log.
+        """
+        if self.skip_stamp == stamp:
+            return True
+        try:
+            with self.path.open("rb") as f:
+                head = f.read(STAMP.size + 2 * COUNT.size)
+                if len(head) < STAMP.size + 2 * COUNT.size:
+                    return False
+                skips, = COUNT.unpack_from(head, STAMP.size + COUNT.size)
+                data = head + f.read(skips * SKIP.size)
+        except FileNotFoundError:
+            return False
+        return self.parse_skips(data, stamp) is not None
+
+    def parse_skips(self, data, stamp):
+        """
+        Parse the head of the index file up to the end of the skip table.
+        Return the position right after the table, or None if the data is
+        malformed or stale.
+        """
+        head_size = STAMP.size + 2 * COUNT.size
+        if len(data) < head_size or STAMP.unpack_from(data, 0) != (MAGIC, *stamp):
+            return None
+        skips, = COUNT.unpack_from(data, STAMP.size + COUNT.size)
+        if len(data) < head_size + skips * SKIP.size:
+            return None
+        table = SKIP.iter_unpack(data[head_size : head_size + skips * SKIP.size])
+        self.skip_keys, self.skip_offsets = [], []
+        for ordinal, offset in table:
+            self.skip_keys.append(-ordinal)
+            self.skip_offsets.append(offset)
+        self.skip_stamp = stamp
+        return head_size + skips * SKIP.size
+
+    def save(self, stamp):
+        """ Write the index to disk, marking it as built for given log state """
+        chunks = [STAMP.pack(MAGIC, *stamp), COUNT.pack(len(self.keys)),
+                COUNT.pack(len(self.skip_keys))]
+        for key, offset in zip(self.skip_keys, self.skip_offsets):
+            chunks.append(SKIP.pack(-key, offset))
+        for key, mark, offset in zip(self.keys, self.marks, self.offsets):
+            mark = bytes(mark, "utf-8")
+            chunks.append(RECORD.pack(-key, offset, len(mark)))
+            chunks.append(mark)
+        data = b"".join(chunks)
+        fsutil.replace_file(self.path, lambda f: f.write(data), sync=False)
+        self.stamp = stamp
+        self.skip_stamp = stamp
+
+    def restamp(self, old, new):
+        """
+        Mark the index built for the 'old' state of the log as built for the
+        'new' one, after a change that left every entry's date, mark and
+        offset intact
+        """
+        if fsutil.patch_head(self.path, STAMP.pack(MAGIC, *old), STAMP.pack(MAGIC, *new)):
+            if self.stamp == old:
+                self.stamp = new
+            if self.skip_stamp == old:
+                self.skip_stamp = new
+
+    #--------- modification ---------#
+
+    def rebuild(self, records):
+        """
+        Replace the contents of the index with given (date, mark, offset)
+        triples. The triples must come in the log's order.
+        """
+        self.stamp, self.skip_stamp = None, None
+        self.keys, self.marks, self.offsets = [], [], []
+        for date, mark, offset in records:
+            self.keys.append(-date.toordinal())
+            self.marks.append(mark)
+            self.offsets.append(offset)
+        self.skip_keys = self.keys[::SKIP_INTERVAL]
+        self.skip_offsets = self.offsets[::SKIP_INTERVAL]
+
+    #--------- lookup ---------#
+
+    def lookup(self, date, mark):
+        """
+        Return the offset of the entry with given date and mark, or None if
+        there's no such entry
+        """
+        key = -date.toordinal()
+        lo = bisect.bisect_left(self.keys, key)
+        hi = bisect.bisect_right(self.keys, key, lo)
+        for i in range(lo, hi):
+            if self.marks[i] == mark:
+                return self.offsets[i]
+        return None
+
+    def place(self, date):
+        """
+        Return the offset of the first entry made on given date or earlier,
+        which is where a new entry made on that date goes, or None if all the
+        entries were made later
+        """
+        i = bisect.bisect_left(self.keys, -date.toordinal())
+        return self.offsets[i] if i < len(self.offsets) else None
+
+    def range(self, before=None, after=None):
+        """
+        Return a pair of positions delimiting the records of the entries made
+        within given interval
+        """
+        lo, hi = 0, len(self.keys)
+        if before is not None:
+            lo = bisect.bisect_right(self.keys, -before.toordinal())
+        if after is not None:
+            hi = bisect.bisect_left(self.keys, -after.toordinal(), lo)
+        return lo, hi
+
+    def seek(self, before):
+        """
+        Return an offset in the log such that all the entries preceding it
+        were made on 'before' date or later. Only the skip table is used.
+        """
+        i = bisect.bisect_right(self.skip_keys, -before.toordinal()) - 1
+        return self.skip_offsets[i] if i >= 0 else 0
+
+    def __len__(self):
+        return len(self.keys)
+
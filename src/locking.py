@@ -0,0 +1,70 @@
+""" A module for coordinating access to the log between processes """
+
+import contextlib
+import os
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SHARED = "shared"
+EXCLUSIVE = "exclusive"
+
+class FileLock():
+    """
+    A reader/writer lock shared between processes, implemented with flock(2)
+    on a lock file. Any number of processes may hold the lock in shared mode,
+    or a single process in exclusive mode.
+
+    The lock is reentrant within a process: nested acquisitions reuse the
+    outer one, and a nested exclusive acquisition inside a shared one upgrades
+    the lock until the inner block is left. On systems without fcntl module
+    the lock does nothing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.mode = None
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def held(self, exclusive=False, blocking=True):
+        """
+        Hold the lock for the duration of a 'with' block. The block receives
+        True, or False if 'blocking' is False and the lock is busy, in which
+        case the lock is not held.
+        """
+        if fcntl is None:
+            yield True
+            return
+        outer = self.mode
+        wanted = EXCLUSIVE if exclusive else SHARED
+        if self.depth == 0:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if outer is None or (wanted == EXCLUSIVE and outer == SHARED):
+            flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(self.fd, flags)
+            except BlockingIOError:
+                if self.depth == 0:
+                    os.close(self.fd)
+                    self.fd = None
+                yield False
+                return
+            self.mode = wanted
+        self.depth += 1
+        try:
+            yield True
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                os.close(self.fd)
+                self.fd, self.mode = None, None
+            elif self.mode != outer:
+                fcntl.flock(self.fd, fcntl.LOCK_SH)
+                self.mode = outer
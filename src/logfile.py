@@ -1,93 +1,652 @@
 """ This module contains a wrapper around I/O to the log file """
 
+import bisect
+import contextlib
+import datetime
+import functools
+import mmap
+import os
+
+import delta
 import entry
+import formats
+import fsutil
+import index
+import locking
+import marks
+import profiling
+import storage
+
+# the delta log is merged into the log file once it holds this many records
+COMPACT_THRESHOLD = 256
+
+# durability levels: flush every change to disk, flush appends to the delta
+# log only once per SYNC_BATCH records, or never flush explicitly. Rewrites of
+# the log file are atomic regardless of the level.
+DURABILITY_LEVELS = ["always", "batched", "never"]
+SYNC_BATCH = 16
+
+# the flag of generator functions' code objects, as in 'inspect' module, which
+# is too slow to import on every start-up
+CO_GENERATOR = 0x20
 
-class Logfile():
+#--------- locking ---------#
+
+def exclusive(method):
+    """ Make a Logfile method hold the log's lock in exclusive mode """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.held(exclusive=True):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def shared(method):
+    """
+    Make a Logfile method hold the log's lock in shared mode. Generators hold
+    the lock until they are exhausted or closed.
+    """
+    if method.__code__.co_flags & CO_GENERATOR:
+        @functools.wraps(method)
+        def generator(self, *args, **kwargs):
+            with self.lock.held():
+                yield from method(self, *args, **kwargs)
+        return generator
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.held():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class Logfile(storage.Storage):
     """
     This class provides I/O operations on the log file
 
     All the methods that take 'before' and 'after' optional arguments will
     operate only on entries made before or after their respective argument
     values.
+
+    'durability' is one of DURABILITY_LEVELS. If 'compress' is True, long
+    entries are compressed when the log file is written in version 2 layout.
+
+    Reading methods hold a lock on the log in shared mode and writing methods
+    in exclusive mode, so concurrent processes never see the log in the middle
+    of a change. Callers may hold the lock themselves to make a sequence of
+    calls atomic.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, durability="always", compress=False):
         self.path = path
+        self.durability = durability
+        self.compress = compress
+        self.lock = locking.FileLock(path.with_name(path.name + ".lock"))
+        self.memory = None
+        self.memory_stamp = None
+        self.index = index.Index(path.with_name(path.name + ".idx"))
+        self.delta = delta.Delta(path.with_name(path.name + ".delta"))
+        self.marks = marks.MarkIndex(path.with_name(path.name + ".marks"))
+
+    # the trigram index and the query cache are only needed by 'grep' and by
+    # the changes of the log, so they are set up, and their modules imported,
+    # on first use
+
+    @functools.cached_property
+    def trigrams(self):
+        """ The trigram index of the entries' contents """
+        import trigrams
+        return trigrams.TrigramIndex(self.path.with_name(self.path.name + ".tri"))
+
+    @functools.cached_property
+    def cache(self):
+        """ The cache of the results of 'grep' """
+        import cache
+        return cache.QueryCache(self.path.with_name(self.path.name + ".cache"))
 
     def ensure_existence(self):
         """ Create the log file if it doesn't exist """
         if not self.path.exists():
             self.path.touch()
 
+    def recover(self):
+        """
+        Clean up after interrupted rewrites. Rewrites never touch the log file
+        or its indices until the new versions are complete, so leftover
+        temporary files are simply dropped. This is only done if no other
+        process uses the log at the moment.
+        """
+        with self.lock.held(exclusive=True, blocking=False) as acquired:
+            if acquired:
+                for tmp in self.path.parent.glob(self.path.name + "*" + fsutil.TEMP_SUFFIX):
+                    tmp.unlink()
+
+    def segments(self):
+        """ Return a list of the logs the entries are kept in """
+        return [self]
+
+    def files(self):
+        """ Return a list of the files holding the entries """
+        return [self.path, self.delta.path]
+
+    def load(self, entries):
+        """ Replace the entries of the log with given ones """
+        self.rewrite(entries, max(formats.LAYOUTS))
+        self.delta.clear()
+
+    def destroy(self):
+        """ Remove the log file with its delta log and indices """
+        for path in [self.path, self.delta.path, self.index.path, self.marks.path,
+                self.trigrams.path, self.cache.path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    #--------- the offset index ---------#
+
+    def stamp(self):
+        """ Return a pair identifying current state of the log file """
+        st = self.path.stat()
+        return st.st_size, st.st_mtime_ns
+
+    def stamps(self):
+        """
+        Return a list identifying current state of both the log file and the
+        delta log, or None if the log file doesn't exist
+        """
+        try:
+            st = self.path.stat()
+        except FileNotFoundError:
+            return None
+        try:
+            dst = self.delta.path.stat()
+            return [st.st_size, st.st_mtime_ns, dst.st_size, dst.st_mtime_ns]
+        except FileNotFoundError:
+            return [st.st_size, st.st_mtime_ns, 0, 0]
+
+    @profiling.timed("offset index")
+    def fresh_index(self):
+        """
+        Return the offset index of the log file, rebuilding it if it is stale.
+        The index doesn't cover the changes in the delta log.
+        """
+        stamp = self.stamp()
+        if not self.index.load(stamp):
+            self.index.rebuild(self.base_records())
+            self.index.save(stamp)
+        return self.index
+
+    def fresh_skips(self):
+        """
+        Return the offset index with at least its skip table loaded, rebuilding
+        the index if it is stale
+        """
+        if self.index.load_skips(self.stamp()):
+            return self.index
+        return self.fresh_index()
+
+    @profiling.timed("mark index")
+    def fresh_marks(self):
+        """ Return the mark index of the log file, rebuilding it if stale """
+        stamp = self.stamp()
+        if not self.marks.load(stamp):
+            self.marks.rebuild(self.base_records())
+            self.marks.save(stamp)
+        return self.marks
+
+    @profiling.timed("trigram index")
+    def fresh_trigrams(self):
+        """ Return the trigram index of the log file, rebuilding it if stale """
+        stamp = self.stamp()
+        if not self.trigrams.load(stamp):
+            self.trigrams.rebuild(e.contents for e in self.base_entries())
+            self.trigrams.save(stamp)
+        return self.trigrams
+
+    @profiling.timed("rewrite")
+    def rewrite(self, entries, version=None):
+        """
+        Overwrite the log with given entries, keeping the indices in sync. The
+        trigram index is dropped instead, to be built anew by the next 'grep'
+        that needs it, so that the change compacting the log doesn't pay for
+        decoding all the entries.
+
+        The log file keeps its current layout unless a layout 'version' is
+        given. Empty logs are written in the latest layout.
+        """
+        entries = list(entries)
+        if version is None:
+            with self.mapped() as mm:
+                version = formats.detect(mm).version
+        layout = formats.LAYOUTS[version]()
+        offsets = fsutil.replace_file(self.path,
+                lambda f: layout.dump(f, entries, self.compress),
+                self.durability != "never")
+        records = [(e.date, e.mark, offset) for e, offset in zip(entries, offsets)]
+        stamp = self.stamp()
+        self.index.rebuild(records)
+        self.index.save(stamp)
+        self.marks.rebuild(records)
+        self.marks.save(stamp)
+        self.trigrams.drop()
+
+    def entry_at(self, offset):
+        """
+        Read the entry starting at given offset. The entry is decoded right
+        away, as it usually outlives the lock on the log, and the record may
+        be overwritten in place once the lock is released.
+        """
+        e = next(self.entries_at([offset]))
+        e.materialize()
+        return e
+
+    #--------- keeping the log in memory ---------#
+
+    def keep_in_memory(self):
+        """
+        Keep decoded entries of the log file in memory between calls, reloading
+        them whenever the log file changes. Meant for long-running processes.
+        """
+        self.memory = {}
+        self.memory_stamp = None
+
+    def memory_entries(self):
+        """
+        Return a dict mapping offsets of the entries of the log file to the
+        entries, in the log's order, or None if the log isn't kept in memory
+        """
+        if self.memory is None:
+            return None
+        stamp = self.stamp()
+        if stamp != self.memory_stamp:
+            memory = {}
+            with self.mapped() as mm:
+                layout = formats.detect(mm)
+                for offset, key, mark, cont_at, end, extra in layout.walk(mm):
+                    e = entry.EntryView(mm, layout, offset, key, mark, cont_at,
+                            end, extra)
+                    e.materialize()
+                    memory[offset] = e
+            self.memory = memory
+            self.memory_stamp = stamp
+        return self.memory
+
     #--------- writing to the log ---------#
 
     def prepend(self, e):
-        """ Place the entry in the head of the file """
-        with self.path.open("rb+") as f:
-            old = f.read()
-            f.seek(0)
-            f.write(e.to_bytes())
-            f.write(old)
+        """ Place the entry in the head of the log """
+        self.record([(delta.PUT, e)])
 
+    @exclusive
     def replace(self, new_e):
-        """ Replace the entry with the same date and mark as the given one """
-        all_entries = list(self.all_entries())
-        with self.path.open("wb") as f:
-            for old_e in all_entries:
-                if new_e.match(old_e):
-                    f.write(new_e.to_bytes())
-                else:
-                    f.write(old_e.to_bytes())
+        """
+        Replace the entry with the same date and mark as the given one. The
+        record of the entry is overwritten in place if possible, otherwise the
+        new version is appended to the delta log. Either way, the entry keeps
+        its place among the entries of its day.
+        """
+        if not self.splice(new_e):
+            self.record([(delta.PUT, new_e)])
+
+    @profiling.timed("splice")
+    def splice(self, new_e):
+        """
+        Overwrite the record of an entry in the log file with a new version,
+        if the new record takes exactly as many bytes as the old one and the
+        log is flushed after every change. Return whether the record was
+        overwritten.
+
+        The new version is appended to the delta log first and dropped from
+        it once the record is overwritten, so an interrupted write leaves the
+        damaged record overridden. The dates, marks and offsets of the entries
+        stay the same, so the indices are only marked as up to date. The
+        cached results of 'grep' are dropped, as the record may no longer
+        match. The modification time of the log file is moved forward if
+        needed, so that the stamp of the log changes even with the size kept.
+        """
+        if self.durability != "always" or (new_e.date, new_e.mark) in self.delta.load():
+            return False
+        idx = self.fresh_index()
+        offset = idx.lookup(new_e.date, new_e.mark)
+        if offset is None:
+            return False
+        with self.mapped() as mm:
+            layout = formats.detect(mm)
+            old_e = layout.read_entry(mm, offset)
+            data = layout.pack(new_e, self.compress)
+            if len(data) != old_e.end - offset:
+                return False
+            old_contents = old_e.contents
+        old_stamp = self.stamp()
+        delta_size = self.delta.valid_size
+        self.delta.append([(delta.PUT, new_e)])
+        with self.path.open("r+b") as f:
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+            st = fsutil.advance_mtime(self.path, old_stamp[1])
+            os.fsync(f.fileno())
+        profiling.count("bytes written", len(data))
+        stamp = st.st_size, st.st_mtime_ns
+        self.cache.clear(stamp)
+        self.index.restamp(old_stamp, stamp)
+        self.marks.restamp(old_stamp, stamp)
+        if self.trigrams.exists() and self.trigrams.load(old_stamp):
+            pos = bisect.bisect_left(idx.offsets, offset)
+            self.trigrams.update(pos, old_contents, new_e.contents)
+            self.trigrams.save(stamp)
+        if self.memory_stamp == old_stamp:
+            with self.mapped() as mm:
+                self.memory[offset] = formats.detect(mm).read_entry(mm, offset)
+                self.memory[offset].materialize()
+            self.memory_stamp = stamp
+        self.delta.truncate(delta_size)
+        return True
 
     def insert_by_date(self, new_e):
         """ Insert the new entry in between old ones """
-        leave, shift = self.span(lambda e: e > new_e)
-        with self.path.open("wb") as f:
-            for old_e in leave:
-                f.write(old_e.to_bytes())
-            f.write(new_e.to_bytes())
-            for old_e in shift:
-                f.write(old_e.to_bytes())
+        self.record([(delta.PUT, new_e)])
+
+    @exclusive
+    @profiling.timed("record changes")
+    def record(self, changes):
+        """
+        Append a list of (op, entry) changes to the delta log, compacting the
+        log if the delta has grown too long
+        """
+        if not changes:
+            return
+        if self.durability == "always":
+            sync = True
+        elif self.durability == "batched":
+            self.delta.load()
+            done = self.delta.records
+            sync = done // SYNC_BATCH != (done + len(changes)) // SYNC_BATCH
+        else:
+            sync = False
+        self.delta.append(changes, sync)
+        self.delta.load()
+        if self.delta.records >= COMPACT_THRESHOLD:
+            self.compact()
+
+    @exclusive
+    def import_entries(self, entries):
+        """
+        Merge many entries into the log in a single pass. Entries with the same
+        date and mark, both among the new ones and in the log, are merged the
+        same way 'add' merges them. The log file is rewritten once, and the
+        delta log is compacted along the way.
+        """
+        # the delta log is compacted first: if the process dies after the new log
+        # file is in place but before the delta log is gone, replaying the delta
+        # log over the imported entries would undo the merges
+        self.compact()
+        incoming = {}
+        for e in entries:
+            key = (e.date, e.mark)
+            if key in incoming:
+                incoming[key].merge(e)
+            else:
+                incoming[key] = e
+        if not incoming:
+            return
+        # the new entries go ahead of the entries of the same day, the latest
+        # imported first, as 'add' would put them, while the rest are merged
+        # into the entries of the log
+        idx = self.fresh_index()
+        pending = sorted((e for key, e in incoming.items() if idx.lookup(*key) is None),
+                key=lambda e: e.date)
+        merged = []
+        for e in self.all_entries():
+            while pending and pending[-1].date >= e.date:
+                merged.append(pending.pop())
+            new = incoming.get((e.date, e.mark))
+            if new is not None:
+                e = entry.Entry(e.contents, e.date, e.mark)
+                e.merge(new)
+            merged.append(e)
+        merged.extend(reversed(pending))
+        self.rewrite(merged)
+
+    @exclusive
+    def migrate(self):
+        """
+        Convert the log file to the latest layout, merging the delta log into
+        it along the way
+        """
+        self.rewrite(list(self.all_entries()), max(formats.LAYOUTS))
+        self.delta.clear()
+
+    def version(self):
+        """ Return the version of the log file's layout """
+        with self.mapped() as mm:
+            return formats.detect(mm).version
+
+    @exclusive
+    def compact(self):
+        """ Merge the delta log into the log file """
+        if not self.delta.load():
+            return
+        # the delta log is only dropped once the new log file is in place.
+        # Replaying it over the compacted log is harmless, should the process
+        # die in between
+        self.rewrite(list(self.all_entries()))
+        self.delta.clear()
 
     #--------- removing entries from the log ---------#
 
+    @exclusive
     def remove(self, date, mark):
         """ Remove specific entry from the log """
-        all_entries = list(self.all_entries())
-        with self.path.open("wb") as f:
-            for e in all_entries:
-                if not (e.date == date and e.mark == mark):
-                    f.write(e.to_bytes())
+        old = self.find_specific(date, mark)
+        if old is not None:
+            self.record([(delta.DELETE, entry.Entry("", date, mark))])
 
-    def remove_several(self, predicate, before=None, after=None):
-        """ Remove all entries such that predicate(entry) is True """
-        all_entries = list(self.all_entries())
-        with self.path.open("wb") as f:
-            for e in all_entries:
-                if not (predicate(e) and before_after(e, before, after)):
-                    f.write(e.to_bytes())
+    @exclusive
+    def remove_several(self, predicate, before=None, after=None, mark=None):
+        """
+        Remove all entries such that predicate(entry) is True. If 'mark' is
+        not None, only entries with this mark are considered.
+        """
+        doomed = self.filter_entries(predicate, before, after, mark)
+        self.record([(delta.DELETE, entry.Entry("", e.date, e.mark))
+            for e in doomed])
 
     #--------- querying entries in bulk ---------#
 
-    def filter_entries(self, predicate, before=None, after=None):
-        """ Return an iterator of entries such that predicate(entry) is True """
+    def map(self):
+        """
+        Return a read-only memory map of the log file, or an empty bytes object
+        if the file is empty. The map is closed once nothing refers to it, so
+        lazily decoded entries may keep using it.
+        """
         with self.path.open("rb") as f:
-            while True:
-                try:
-                    new = entry.Entry.from_binary_file(f)
-                    if predicate(new) and before_after(new, before, after):
-                        yield new
-                except entry.EntryReadError:
+            size = os.fstat(f.fileno()).st_size
+            profiling.count("bytes mapped", size)
+            if size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def mapped(self):
+        """
+        Return a read-only memory map of the log file, to be closed at the end
+        of a 'with' block
+        """
+        mm = self.map()
+        if isinstance(mm, bytes):
+            return contextlib.nullcontext(mm)
+        return mm
+
+    def base_records(self):
+        """
+        Return an iterator of (date, mark, offset) triples of the entries in
+        the log file, reading only the entries' headers and marks
+        """
+        with self.mapped() as mm:
+            layout = formats.detect(mm)
+            for offset, key, mark, _, _, _ in layout.walk(mm):
+                yield layout.date(key), mark, offset
+
+    def base_entries(self, before=None, after=None, mark=None, reverse=False):
+        """
+        Return an iterator of entries stored in the log file itself, from the
+        latest to the oldest, or in reverse order if 'reverse' is True.
+
+        Entries with given mark are found through the mark index. Otherwise
+        only the headers of the entries are examined until an entry is known
+        to be made within given interval, so the contents of all the other
+        entries are never copied or decoded. The entries that are yielded
+        decode their contents and dates only when these are accessed.
+
+        The log file is sorted from the latest entry to the oldest, so the
+        scan starts at an offset found in the index's skip table and stops at
+        the first entry made on 'after' date or earlier. The reverse order,
+        as well as the order of entries kept in memory, is produced by
+        following the offset index.
+        """
+        if mark is not None:
+            offsets = self.fresh_marks().offsets(mark, before, after)
+            yield from self.entries_at(reversed(offsets) if reverse else offsets)
+            return
+        if self.memory is not None and not reverse:
+            idx = self.fresh_index()
+            lo, hi = idx.range(before, after)
+            yield from self.entries_at(idx.offsets[i] for i in range(lo, hi))
+            return
+        if reverse:
+            idx = self.fresh_index()
+            lo, hi = idx.range(before, after)
+            yield from self.entries_at(idx.offsets[i] for i in range(hi - 1, lo - 1, -1))
+            return
+        start = 0
+        if before is not None:
+            start = self.fresh_skips().seek(before)
+        # the yielded entries are decoded lazily and keep the map open
+        mm = self.map()
+        layout = formats.detect(mm)
+        before = before and layout.key(before)
+        after = after and layout.key(after)
+        view = memoryview(mm)
+        decoded = 0
+        try:
+            for offset, key, mark, cont_at, end, extra in layout.walk(view, start):
+                if before is not None and key >= before:
+                    continue
+                if after is not None and key <= after:
                     break
+                decoded += 1
+                yield entry.EntryView(mm, layout, offset, key, mark, cont_at, end,
+                        extra)
+        finally:
+            view.release()
+            profiling.count("entries read", decoded)
 
-    def all_entries(self, before=None, after=None):
-        """ Return all the entries in the log """
-        return self.filter_entries(lambda e: True, before, after)
+    def entries_at(self, offsets):
+        """ Return an iterator of entries of the log file at given offsets """
+        memory = self.memory_entries()
+        if memory is not None:
+            for offset in offsets:
+                yield memory[offset]
+            return
+        # the yielded entries are decoded lazily and keep the map open
+        mm = self.map()
+        layout = formats.detect(mm)
+        decoded = 0
+        try:
+            for offset in offsets:
+                decoded += 1
+                yield layout.read_entry(mm, offset)
+        finally:
+            profiling.count("entries read", decoded)
+
+    def indexed_entries(self, positions, before=None, after=None, mark=None):
+        """
+        Return an iterator of entries of the log file with given positions in
+        the offset index
+        """
+        idx = self.fresh_index()
+        before = before and -before.toordinal()
+        after = after and -after.toordinal()
+        def offsets():
+            for pos in positions:
+                key = idx.keys[pos]
+                if before is not None and key <= before:
+                    continue
+                if after is not None and key >= after:
+                    continue
+                if mark is not None and idx.marks[pos] != mark:
+                    continue
+                yield idx.offsets[pos]
+        return self.entries_at(offsets())
+
+    @shared
+    def merged_entries(self, before=None, after=None, mark=None, reverse=False):
+        """
+        Return an iterator of all the entries, with the changes from the delta
+        log applied, from the latest to the oldest, or in reverse order if
+        'reverse' is True
+        """
+        base = self.base_entries(before, after, mark, reverse)
+        yield from self.merge_delta(base, before, after, mark, reverse)
+
+    def merge_delta(self, base, before=None, after=None, mark=None, reverse=False):
+        """
+        Apply the changes from the delta log to an iterator of entries from the
+        log file, which come in the order given by 'reverse'. The result
+        includes the entries added in the delta log made within given interval
+        and with given mark, if it's not None.
+
+        A changed entry takes the place of its record in the log file, and an
+        added one goes ahead of the entries made on the same date or earlier,
+        the latest added first, which is where the log file would have it.
+        """
+        overrides = self.delta.load()
+        if not overrides:
+            yield from base
+            return
+        idx = self.fresh_index()
+        end = idx.stamp[0]
+        # the places of the entries from the delta log are the doubled offsets
+        # of the records in the log file they replace, or, less one, of the
+        # records they go ahead of. The records overridden are dropped by
+        # their offsets, so the entries of the log file aren't even decoded
+        pending = []
+        dropped = set()
+        for (date, e_mark), e in reversed(overrides.items()):
+            offset = idx.lookup(date, e_mark)
+            if offset is not None:
+                dropped.add(offset)
+            if e is None or not before_after(e, before, after) \
+                    or (mark is not None and e_mark != mark):
+                continue
+            if offset is not None and (date, e_mark) not in self.delta.readded:
+                pending.append((2 * offset, e))
+                continue
+            offset = idx.place(date)
+            pending.append((2 * (end if offset is None else offset) - 1, e))
+        pending.sort(key=lambda p: p[1].date, reverse=True)
+        pending.sort(key=lambda p: p[0])
+        if not reverse:
+            pending.reverse()
+        for e in base:
+            place = 2 * e.offset
+            if reverse:
+                while pending and pending[-1][0] > place:
+                    yield pending.pop()[1]
+            else:
+                while pending and pending[-1][0] < place:
+                    yield pending.pop()[1]
+            if e.offset not in dropped:
+                yield e
+            elif pending and pending[-1][0] == place:
+                yield pending.pop()[1]
+        while pending:
+            yield pending.pop()[1]
 
     def matching_entries(self, date, mark, before=None, after=None):
         """ Return a list of entries with given date and mark """
-        return self.filter_entries(lambda e: e.date == date and e.mark == mark,
-                before, after)
+        found = self.find_specific(date, mark)
+        if found is not None and before_after(found, before, after):
+            return [found]
+        return []
 
     def span(self, predicate):
         """
@@ -106,50 +665,114 @@ class Logfile():
                 break
         return all_entries[:i], all_entries[i:]
 
-    def grep(self, regex, before=None, after=None):
-        """ Return an iterator with all entries matching given regex """
-        for e in self.all_entries():
-            if not before_after(e, before, after): continue
-            lines = e.contents.splitlines()
-            single_line = " ".join(lines)
-            if regex.match(single_line):
+    @shared
+    def grep(self, pattern, before=None, after=None, mark=None, reverse=False,
+            jobs=1):
+        """
+        Return an iterator with all entries matching given search.Pattern.
+
+        If the pattern requires some literal strings to be present in the
+        matches, the candidates are first narrowed down with the trigram index,
+        and then checked for the strings before running the regex itself.
+        Otherwise, if 'jobs' is more than 1, the log file is searched by that
+        many processes at once.
+        """
+        matches = profiling.timed("regex matching")(pattern.matches)
+        query = repr(("grep", pattern.key, before and before.toordinal(),
+                after and after.toordinal(), mark))
+        stamp = self.stamp()
+        offsets = self.cache.get(query, stamp)
+        if offsets is None:
+            offsets = self.grep_offsets(pattern, matches, before, after, mark,
+                    jobs)
+            self.cache.put(query, stamp, offsets)
+        base = self.entries_at(reversed(offsets) if reverse else offsets)
+        for e in self.merge_delta(base, before, after, mark, reverse):
+            # the entries of the log file itself are known to match, only the
+            # ones from the delta log are checked
+            if isinstance(e, entry.EntryView) or matches(e.contents):
+                profiling.count("entries matched")
                 yield e
-            else:
-                for line in lines:
-                    if regex.match(line):
-                        yield e
-                        break
 
-    def grep_marked(self, regex, mark, before=None, after=None):
-        """ Return an iterator with all entries with given mark matching given regex """
-        return filter(lambda e: e.mark == mark, self.grep(regex, before, after))
+    def grep_offsets(self, pattern, matches, before, after, mark, jobs):
+        """
+        Return a list of offsets of the entries of the log file matching given
+        pattern, in the log's order, ignoring the delta log
+        """
+        if pattern.literals:
+            positions = self.fresh_trigrams().candidates(pattern.literals)
+            if positions is not None:
+                return [e.offset for e in self.indexed_entries(positions, before,
+                        after, mark) if matches(e.contents)]
+        if jobs > 1:
+            offsets = self.parallel_grep(pattern, before, after, mark, jobs)
+            if offsets is not None:
+                return offsets
+        return [e.offset for e in self.base_entries(before, after, mark)
+                if matches(e.contents)]
+
+    def parallel_grep(self, pattern, before, after, mark, jobs):
+        """
+        Return a list of offsets of the entries of the log file matching given
+        pattern, found by at most given number of processes, or None if the log
+        is too short for the workers to pay off. The log is split into ranges
+        of records with the offset index.
+        """
+        import search
+        idx = self.fresh_index()
+        lo, hi = idx.range(before, after)
+        jobs = search.parallel_jobs(hi - lo, jobs)
+        if jobs == 1:
+            return None
+        ranges = search.split(idx.offsets, lo, hi, jobs * search.RANGES_PER_JOB)
+        return search.parallel_search(self.path, ranges, pattern, mark, jobs)
+
+    @shared
+    def mark_catalog(self):
+        """
+        Return a dict mapping every mark in the log to a triple of the number
+        of entries with this mark and the dates of the oldest and the latest
+        of them. It is computed from the mark index and the delta log alone.
+        """
+        postings = self.fresh_marks().postings
+        changed, added = {}, {}
+        for (date, mark), e in self.delta.load().items():
+            changed.setdefault(mark, set()).add(date.toordinal())
+            if e is not None:
+                added.setdefault(mark, []).append(date.toordinal())
+        catalog = {}
+        for mark in set(postings) | set(added):
+            ordinals = postings[mark][0] if mark in postings else []
+            if mark in changed:
+                ordinals = [o for o in ordinals if o not in changed[mark]]
+            extra = added.get(mark, [])
+            count = len(ordinals) + len(extra)
+            if count == 0:
+                continue
+            ends = [*ordinals[:1], *ordinals[-1:], *extra]
+            catalog[mark] = (count, datetime.date.fromordinal(min(ends)),
+                    datetime.date.fromordinal(max(ends)))
+        return catalog
 
     #--------- querying entries one by one ---------#
 
     def find_entry(self, predicate):
         """ Return the newest entry such that predicate(entry) is True """
-        with self.path.open("rb") as f:
-            while True:
-                try:
-                    new = entry.Entry.from_binary_file(f)
-                    if predicate(new): return new
-                except entry.EntryReadError:
-                    return None
+        return next(self.filter_entries(predicate), None)
 
+    @shared
     def find_specific(self, date, mark=""):
         """
         Return an entry with given date and mark, or None if such an entry does
         not exist.
         """
-        return self.find_entry(lambda e: e.date == date and e.mark == mark)
-
-    def last_entry(self):
-        """ Return the latest entry, or None if the log is empty """
-        with self.path.open("rb") as f:
-            try:
-                return entry.Entry.from_binary_file(f)
-            except entry.EntryReadError:
-                return None
+        overrides = self.delta.load()
+        if (date, mark) in overrides:
+            return overrides[(date, mark)]
+        offset = self.fresh_index().lookup(date, mark)
+        if offset is None:
+            return None
+        return self.entry_at(offset)
 
 #--------- helper functions ---------#
 
@@ -1,29 +1,63 @@
 """ This module contains a class for configuration of the logger. """
 
+# modules needed only by some of the commands are imported where they are
+# used, to keep the start-up fast
+
 import datetime
 import os
 import pathlib
 import re
 import sys
-import subprocess
 
 import entry
 import logfile
+import output
+import profiling
+import shards
+import storage
 
 #--------- main class ---------#
 
 class Logger():
     """ Main processing class """
 
-    def __init__(self, args):
-        try:
-            self.editor = os.environ["EDITOR"]
-        except KeyError:
-            print("The logger requires EDITOR environment variable to be set.")
+    def __init__(self, args, log=None):
+        # EDITOR is only checked by the commands running it
+        self.editor = os.environ.get("EDITOR")
+        self.logdir = log_directory()
+        self.config = read_config(self.logdir / "config")
+        # parse '--durability', falling back to the configuration file
+        durability = args.durability or self.config.get("durability", "always")
+        if durability not in logfile.DURABILITY_LEVELS:
+            levels = ", ".join(logfile.DURABILITY_LEVELS)
+            print(f"Invalid durability level '{durability}', expected one of: {levels}.")
+            raise ConfigError()
+        compression = self.config.get("compression", "none")
+        if compression not in ["none", "zlib"]:
+            print(f"Invalid compression '{compression}', expected 'none' or 'zlib'.")
+            raise ConfigError()
+        backend = self.config.get("storage", "binary")
+        if backend not in storage.BACKENDS:
+            backends = ", ".join(storage.BACKENDS)
+            print(f"Invalid storage '{backend}', expected one of: {backends}.")
+            raise ConfigError()
+        sharding = self.config.get("sharding", "none")
+        if sharding not in ["none"] + shards.PERIODS:
+            periods = ", ".join(["none"] + shards.PERIODS)
+            print(f"Invalid sharding '{sharding}', expected one of: {periods}.")
+            raise ConfigError()
+        if backend != "binary" and sharding != "none":
+            print("Only the binary storage can be sharded.")
             raise ConfigError()
-        self.logdir = pathlib.Path.home() / ".simlog"
-        self.logfile = logfile.Logfile(self.logdir / "log")
-        self.entryfile = self.logdir / "entry"
+        # a long-running process may share one log between many commands
+        if log is None:
+            log = storage.open_log(self.logdir / "log", backend, sharding,
+                    durability, compression == "zlib")
+        self.logfile = log
+        # every process gets its own scratch file, so that parallel invocations
+        # don't clobber each other's entries
+        self.entryfile = self.logdir / f"entry.{os.getpid()}"
+        self.out = output.Output()
         self.command = args.command
         self.mark = args.mark
         self.reverse = args.reverse
@@ -31,6 +65,14 @@ class Logger():
         self.no_dates = args.silent or args.no_dates
         self.no_ends = args.silent or args.no_ends
         self.from_stdin = args.from_stdin
+        # parse '--jobs', 0 meaning one process per core
+        if args.jobs < 0:
+            print("The number of jobs can't be negative.")
+            raise ConfigError()
+        self.jobs = args.jobs or os.cpu_count() or 1
+        # the file and the format of 'import' and 'export' commands
+        self.file = getattr(args, "file", None)
+        self.format = getattr(args, "format", None)
         # parse '--date'
         if args.date is None:
             self.date = datetime.date.today()
@@ -40,13 +82,16 @@ class Logger():
                 print(INVALID_DATE)
                 raise ConfigError()
         # compile regex if it is given
-        try:
-            self.regex = re.compile(".*" + args.regex + ".*")
-        except re.error as e:
-            print(f"Error when parsing regex: {e.args[0]}.")
+        self.regex = None
+        if getattr(args, "regex", None) is not None:
+            self.regex = compile_regex(args.regex, args.fixed_strings,
+                    args.ignore_case)
+        # parse 'follow' and 'export' commands' options
+        self.only_mark = getattr(args, "only_mark", None)
+        self.interval = getattr(args, "interval", 1.0)
+        if self.interval <= 0:
+            print("The interval must be positive.")
             raise ConfigError()
-        except AttributeError:
-            pass # if there's no regex field then we simply don't need it
         # parse '--before' and '--after'
         self.before, self.after = None, None
         if args.before is not None:
@@ -61,9 +106,9 @@ class Logger():
                 raise ConfigError()
         # parse --hide
         if args.hide is not None:
-            self.hide = args.hide.split(",")
+            self.hide = frozenset(args.hide.split(","))
         else:
-            self.hide = []
+            self.hide = frozenset()
 
     def ensure_files(self):
         """
@@ -71,22 +116,48 @@ class Logger():
         """
         if not self.logdir.exists():
             self.logdir.mkdir()
+        # the log may be stored differently since the configuration changed
+        storage.adopt(self.logfile)
         self.logfile.ensure_existence()
+        self.logfile.recover()
         if self.entryfile.exists():
             os.remove(self.entryfile)
 
+    @profiling.timed("format entries")
     def print(self, en):
         """ Apply formatting according to flags and print out the entry """
         no_dates = self.no_dates
         no_marks = self.no_marks
         no_ends = self.no_ends
-        s = en.format(no_date=no_dates, no_mark=no_marks, no_end=no_ends)
-        print(s)
+        profiling.count("entries printed")
+        self.out.write(en.format(no_date=no_dates, no_mark=no_marks, no_end=no_ends))
+        self.out.write("\n")
+
+    def run_editor(self):
+        """ Let the user edit the entry file with EDITOR """
+        import subprocess
+        if self.editor is None:
+            print("The logger requires EDITOR environment variable to be set.")
+            raise ConfigError()
+        try:
+            subprocess.run([self.editor, str(self.entryfile)])
+        except FileNotFoundError:
+            print(f"EDITOR is set to '{self.editor}', which doesn't appear to be"
+                + " a valid command.")
+            raise ConfigError()
 
     #--------- central processing function ---------#
 
     def run(self):
         """ Run the specified command """
+        try:
+            with profiling.phase(f"command {self.command}"):
+                self.dispatch()
+        finally:
+            self.out.flush()
+
+    def dispatch(self):
+        """ Call the method implementing the specified command """
         if self.command == "add":
             self.add(self.date, self.mark)
         elif self.command == "edit":
@@ -105,6 +176,20 @@ class Logger():
             self.grep(self.regex)
         elif self.command == "grep-marked":
             self.grep_marked(self.regex, self.mark)
+        elif self.command == "import":
+            self.import_entries()
+        elif self.command == "marks":
+            self.list_marks()
+        elif self.command == "compact":
+            self.compact()
+        elif self.command == "migrate":
+            self.migrate()
+        elif self.command == "follow":
+            self.follow()
+        elif self.command == "export":
+            self.export()
+        elif self.command == "batch":
+            self.batch()
 
     #--------- commands ---------#
 
@@ -113,12 +198,7 @@ class Logger():
         date = date or datetime.date.today()
         if not self.from_stdin:
             # fire up EDITOR, collect created file
-            try:
-                subprocess.run([self.editor, str(self.entryfile)])
-            except FileNotFoundError:
-                print(f"EDITOR is set to '{self.editor}', which doesn't appear to be"
-                    + " a valid command.")
-                raise ConfigError()
+            self.run_editor()
             if not self.entryfile.exists():
                 raise NoEntryError()
             en = entry.Entry.from_text_file(self.entryfile, date, mark)
@@ -130,18 +210,22 @@ class Logger():
                 contents += new
                 if new == "": break
             en = entry.Entry(contents, date, mark)
-        old_entry = self.logfile.find_specific(date, mark)
-        if old_entry is not None:
-            old_entry.merge(en)
-            self.logfile.replace(old_entry)
-        else:
-            last = self.logfile.last_entry()
-            if last is None or last < en:
-                # the entry needs to be put in the head of the log
-                self.logfile.prepend(en)
+        # the lookup and the write must not be separated by a concurrent change
+        with self.logfile.lock.held(exclusive=True):
+            old_entry = self.logfile.find_specific(date, mark)
+            if old_entry is not None:
+                # the found entry may be cached by the log, so it's left intact
+                merged = entry.Entry(old_entry.contents, date, mark)
+                merged.merge(en)
+                self.logfile.replace(merged)
             else:
-                # the entry needs to be inserted between old entries
-                self.logfile.insert_by_date(en)
+                last = self.logfile.last_entry()
+                if last is None or last < en:
+                    # the entry needs to be put in the head of the log
+                    self.logfile.prepend(en)
+                else:
+                    # the entry needs to be inserted between old entries
+                    self.logfile.insert_by_date(en)
         if not self.from_stdin:
             os.remove(self.entryfile)
 
@@ -153,12 +237,7 @@ class Logger():
             self.add(date, mark)
         else:
             old_entry.to_text_file(self.entryfile, True, True, True)
-            try:
-                subprocess.run([self.editor, str(self.entryfile)])
-            except FileNotFoundError:
-                print(f"EDITOR is set to '{self.editor}', which doesn't appear to be"
-                    + " a valid command.")
-                raise ConfigError()
+            self.run_editor()
             en = entry.Entry.from_text_file(self.entryfile, date, mark)
             self.logfile.replace(en)
             os.remove(self.entryfile)
@@ -176,12 +255,9 @@ class Logger():
 
     def view_marked(self, mark):
         """ View all entries with the given mark """
-        entries = self.logfile.filter_entries(lambda e: e.mark == mark,
-                self.before, self.after)
+        entries = self.logfile.marked_entries(mark, self.before, self.after,
+                reverse=self.reverse)
         empty = True
-        if self.reverse:
-            entries = list(entries)
-            entries.reverse()
         for e in entries:
             self.print(e)
             empty = False
@@ -205,11 +281,9 @@ class Logger():
 
     def view_all(self):
         """ View all entries """
-        entries = self.logfile.all_entries(self.before, self.after)
+        entries = self.logfile.all_entries(self.before, self.after,
+                reverse=self.reverse)
         empty = True
-        if self.reverse:
-            entries = list(entries)
-            entries.reverse()
         for e in entries:
             if e.mark not in self.hide:
                 self.print(e)
@@ -234,16 +308,14 @@ class Logger():
 
     def remove_marked(self, mark):
         """ Remove all entries with given mark """
-        self.logfile.remove_several(lambda e: e.mark == mark,
-                self.before, self.after)
+        self.logfile.remove_several(lambda e: True, self.before, self.after,
+                mark)
 
     def grep(self, regex):
         """ View all entries matching given regex """
-        entries = self.logfile.grep(regex, self.before, self.after)
+        entries = self.logfile.grep(regex, self.before, self.after,
+                reverse=self.reverse, jobs=self.jobs)
         empty = True
-        if self.reverse:
-            entries = list(entries)
-            entries.reverse()
         for e in entries:
             if e.mark not in self.hide:
                 self.print(e)
@@ -264,11 +336,9 @@ class Logger():
 
     def grep_marked(self, regex, mark):
         """ View all entries with given mark matching given regex """
-        entries = self.logfile.grep_marked(regex, mark)
+        entries = self.logfile.grep_marked(regex, mark,
+                reverse=self.reverse, jobs=self.jobs)
         empty = True
-        if self.reverse:
-            entries = list(entries)
-            entries.reverse()
         for e in entries:
             self.print(e)
             empty = False
@@ -287,8 +357,154 @@ class Logger():
                 print(f"No entry with mark {mark} made before {date1} and after {date2} \
                         matches this regex.")
 
+    def follow(self):
+        """ Print entries as they are added or changed, until interrupted """
+        import follow
+        # the watch is set up first, so that no change slips in between
+        watcher = follow.Watcher(self.logdir,
+                [path.name for path in self.logfile.files()], self.interval)
+        try:
+            follower = follow.Follower(self.logfile, self.only_mark, self.regex)
+            while True:
+                watcher.wait()
+                # shards may come and go
+                watcher.names = {path.name for path in self.logfile.files()}
+                for e in follower.changes():
+                    if e.mark not in self.hide:
+                        self.print(e)
+                self.out.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+    def import_entries(self):
+        """ Add many entries to the log at once """
+        if self.file is None or self.file == "-":
+            entries = [parse_import_line(line, n + 1, self.format)
+                    for n, line in enumerate(sys.stdin)
+                    if line.strip() != ""]
+        else:
+            try:
+                with open(self.file, "r") as f:
+                    entries = [parse_import_line(line, n + 1, self.format)
+                            for n, line in enumerate(f)
+                            if line.strip() != ""]
+            except OSError as e:
+                print(f"Can't read '{self.file}': {e.strerror}.")
+                raise ConfigError()
+        self.logfile.import_entries(entries)
+
+    def export(self):
+        """ Write the entries out in a format other tools can read """
+        import export
+        entries = self.logfile.merged_entries(self.before, self.after,
+                self.only_mark, self.reverse)
+        entries = (e for e in entries if e.mark not in self.hide)
+        to_stdout = self.file is None or self.file == "-"
+        try:
+            if self.format == "sqlite":
+                if to_stdout:
+                    print("An SQLite database can't be written to stdout, give a file name.")
+                    raise ConfigError()
+                if not export.write_sqlite(entries, pathlib.Path(self.file)):
+                    print("This SQLite lacks FTS5, the full-text index was not built.")
+                return
+            write = export.write_csv if self.format == "csv" else export.write_jsonl
+            if to_stdout:
+                write(entries, self.out)
+            else:
+                with open(self.file, "w", newline="") as f:
+                    write(entries, f)
+        except OSError as e:
+            print(f"Can't write '{self.file}': {e.strerror}.")
+            raise ConfigError()
+
+    def batch(self):
+        """ Answer many queries read from stdin, reading the log once """
+        import batch
+        queries = [batch.parse_query(line, n + 1)
+                for n, line in enumerate(sys.stdin)
+                if line.strip() != "" and not line.lstrip().startswith("#")]
+        batch.answer(self.logfile, queries)
+        for query in queries:
+            self.out.write(f"=== {query.text} ===\n")
+            if not query.results:
+                self.out.write("No entries.\n")
+            results = reversed(query.results) if query.reverse else query.results
+            # like the commands themselves, only these honor --hide
+            hide = self.hide if query.command in ["view-all", "grep"] else ()
+            for e in results:
+                if e.mark not in hide:
+                    self.print(e)
+
+    def list_marks(self):
+        """ List all marks with numbers of entries and dates they span """
+        catalog = self.logfile.mark_catalog()
+        if not catalog:
+            print("The log is empty")
+            return
+        for mark in sorted(catalog):
+            count, oldest, latest = catalog[mark]
+            name = "Not marked" if mark == "" else f"Marked: {mark}"
+            plural = "entry" if count == 1 else "entries"
+            oldest = oldest.strftime("%Y %b %d")
+            latest = latest.strftime("%Y %b %d")
+            print(f"-- {name} -- {count} {plural} made from {oldest} to {latest}")
+
+    def compact(self):
+        """ Merge pending changes into the log file """
+        self.logfile.compact()
+
+    def migrate(self):
+        """ Convert the log file to the latest format """
+        old = self.logfile.version()
+        if old is None:
+            print("The log is kept in an SQLite database, which needs no migration.")
+            return
+        self.logfile.migrate()
+        new = self.logfile.version()
+        if old == new:
+            print(f"The log is already in format version {new}.")
+        else:
+            print(f"The log was converted from format version {old} to version {new}.")
+
 #--------- helper functions ---------#
 
+def log_directory():
+    """ Return the directory holding the log and its auxiliary files """
+    return pathlib.Path.home() / ".simlog"
+
+def read_config(path):
+    """
+    Return a dict with the settings from the [simlog] section of given
+    configuration file, or an empty dict if there's no such file
+    """
+    if not path.exists():
+        return {}
+    import configparser
+    parser = configparser.ConfigParser()
+    try:
+        parser.read(path)
+    except configparser.Error as e:
+        print(f"Error when parsing configuration file {path}: {e.message}")
+        raise ConfigError()
+    if not parser.has_section("simlog"):
+        return {}
+    return dict(parser["simlog"])
+
+def compile_regex(text, fixed=False, ignore_case=False):
+    """
+    Return a search.Pattern for a regex given on the command line, or for a
+    plain string if 'fixed' is True
+    """
+    import search
+    try:
+        return search.Pattern(text, fixed, ignore_case)
+    except re.error as e:
+        print(f"Error when parsing regex: {e.args[0]}.")
+        raise ConfigError()
+
 def parse_date(string):
     """ Return a date object from a given string, or None if parsing failed """
     formats = ["%Y-%m-%d"
@@ -296,6 +512,13 @@ def parse_date(string):
               , "%Y-%b-%d"
               , "%Y %b %d"
               ]
+    # dates in the first format are parsed without loading strptime's
+    # machinery
+    if len(string) == 10 and string[4] == "-" and string[7] == "-":
+        try:
+            return datetime.date.fromisoformat(string)
+        except ValueError:
+            pass
     for f in formats:
         try:
             return datetime.datetime.strptime(string, f).date()
@@ -303,6 +526,39 @@ def parse_date(string):
             pass
     return None
 
+def parse_import_line(line, number, fmt):
+    """
+    Return an entry described by a line of input of 'import' command, in one
+    of the formats: 'jsonl' for JSON objects with 'date', 'mark' and
+    'contents' fields, or 'tsv' for tab-separated date, mark and contents
+    with backslash escapes.
+    """
+    if fmt == "jsonl":
+        import json
+        try:
+            record = json.loads(line)
+            date, mark, contents = (record["date"], record.get("mark", ""),
+                    record["contents"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            print(f"Line {number}: expected a JSON object with 'date' and 'contents' fields.")
+            raise ConfigError()
+    else:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 3:
+            print(f"Line {number}: expected date, mark and contents separated by tabs.")
+            raise ConfigError()
+        date, mark, contents = fields[0], unescape(fields[1]), unescape(fields[2])
+    parsed = parse_date(date) if isinstance(date, str) else None
+    if parsed is None:
+        print(f"Line {number}: {INVALID_DATE}")
+        raise ConfigError()
+    return entry.Entry(contents, parsed, mark)
+
+def unescape(string):
+    """ Replace backslash escapes for newlines, tabs and backslashes """
+    escapes = {"n": "\n", "t": "\t", "\\": "\\"}
+    return re.sub(r"\\(.)", lambda m: escapes.get(m.group(1), m.group(0)), string)
+
 #--------- errors ---------#
 
 class ConfigError(Exception):
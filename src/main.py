@@ -3,12 +3,43 @@
 """ Main module """
 
 import argparse
+import io
+import os
+import sys
+import time
 
+import entry
+import export
+import logfile
 import logger
+import profiling
 
-def build_parser():
-    """ Construct a command line arguments' parser """
-    parser = argparse.ArgumentParser("simlog")
+class ArgumentParser(argparse.ArgumentParser):
+    """ A parser formatting its help with HelpFormatter below """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("formatter_class", HelpFormatter)
+        super().__init__(*args, **kwargs)
+
+class HelpFormatter(argparse.HelpFormatter):
+    """
+    argparse's formatter of the help, finding the width of the terminal
+    without importing shutil, which would take a good part of the start-up
+    """
+
+    def __init__(self, prog, indent_increment=2, max_help_position=24,
+            width=None):
+        if width is None:
+            width = terminal_width() - 2
+        super().__init__(prog, indent_increment, max_help_position, width)
+
+def build_parser(argv=None):
+    """
+    Construct a command line arguments' parser. Given the arguments, only the
+    subparser of the command among them is built, as building all of them
+    takes a good part of the start-up.
+    """
+    parser = ArgumentParser("simlog")
     parser.add_argument("-m", "--mark", dest="mark",
         help="operate only on entries with given mark",
         default="")
@@ -41,63 +72,325 @@ def build_parser():
         help="don't show entries with marks given in a comma-separated list",
         default=None)
 
+    parser.add_argument("--durability", dest="durability",
+        choices=logfile.DURABILITY_LEVELS, default=None,
+        help="when to flush changes to disk: after every change, after every \
+            few changes, or never explicitly. Overrides 'durability' setting in \
+            the configuration file, the default is 'always'.")
+
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+        help="number of processes searching the log at once in 'grep' and \
+            'grep-marked' commands, 0 for one per CPU core. Default is 1.")
+
+    parser.add_argument("-F", "--fixed-strings", dest="fixed_strings",
+        action="store_true",
+        help="treat the regex of 'grep', 'grep-marked' and 'follow' commands \
+            as a plain string")
+    parser.add_argument("-i", "--ignore-case", dest="ignore_case",
+        action="store_true",
+        help="ignore case when matching the regex of 'grep', 'grep-marked' \
+            and 'follow' commands")
+
+    parser.add_argument("--profile", dest="profile", action="store_const",
+        const="summary", default=None,
+        help="report time spent in every phase of the command, bytes read and \
+            written and entries decoded, matched and printed to stderr. \
+            SIMLOG_TRACE environment variable set to 'summary' does the same.")
+    parser.add_argument("--profile-json", dest="profile", action="store_const",
+        const="json",
+        help="same as '--profile', but report in JSON. SIMLOG_TRACE \
+            environment variable set to 'json' does the same.")
+    parser.add_argument("--profile-dump", dest="profile_dump", default=None,
+        metavar="FILE",
+        help="save cProfile statistics of the command to FILE. \
+            SIMLOG_TRACE_DUMP environment variable does the same.")
+
+    command = None if argv is None else invoked_command(parser, argv)
+    wanted = lambda name: command is None or command == name
+
     subparsers = parser.add_subparsers(help="Available commands", dest="command")
 
     # 'add' command
-    add_parser = subparsers.add_parser("add", help="Add an entry to the log")
+    if wanted("add"):
+        add_parser = subparsers.add_parser("add", help="Add an entry to the log")
 
     # 'edit' command
-    edit_parser = subparsers.add_parser("edit", 
-        help="Edit an entry. If the entry with given date and mark doesn't exist " +
-            "it's equivalent to add command. --from-stdin option is ignored.")
+    if wanted("edit"):
+        edit_parser = subparsers.add_parser("edit", 
+            help="Edit an entry. If the entry with given date and mark doesn't exist " +
+                "it's equivalent to add command. --from-stdin option is ignored.")
 
     # 'view' command
-    view_parser = subparsers.add_parser("view", help="View an entry")
+    if wanted("view"):
+        view_parser = subparsers.add_parser("view", help="View an entry")
 
     # 'view-marked' command
-    view_marked_parser = subparsers.add_parser("view-marked",
-        help="View all marked entries. '--mark' option is ignored")
-    view_marked_parser.add_argument("mark")
+    if wanted("view-marked"):
+        view_marked_parser = subparsers.add_parser("view-marked",
+            help="View all marked entries. '--mark' option is ignored")
+        view_marked_parser.add_argument("mark")
 
     # 'view-all' command
-    view_all_parser = subparsers.add_parser("view-all",
-        help="View all entries.")
+    if wanted("view-all"):
+        view_all_parser = subparsers.add_parser("view-all",
+            help="View all entries.")
 
     # 'remove' command
-    remove_parser = subparsers.add_parser("remove",
-        help="Remove an entry with given date and mark")
+    if wanted("remove"):
+        remove_parser = subparsers.add_parser("remove",
+            help="Remove an entry with given date and mark")
 
     # 'remove-marked' command
-    remove_marked_parser = subparsers.add_parser("remove-marked",
-        help="Remove all the entries with given mark. '--mark' option is ignored")
-    remove_marked_parser.add_argument("mark")
+    if wanted("remove-marked"):
+        remove_marked_parser = subparsers.add_parser("remove-marked",
+            help="Remove all the entries with given mark. '--mark' option is ignored")
+        remove_marked_parser.add_argument("mark")
 
     # 'grep' command
-    grep_parser = subparsers.add_parser("grep",
-        help="View all entries matching given regular expression")
-    grep_parser.add_argument("regex")
+    if wanted("grep"):
+        grep_parser = subparsers.add_parser("grep",
+            help="View all entries matching given regular expression")
+        grep_parser.add_argument("regex")
 
     # 'grep-marked' command
-    grep_marked_parser = subparsers.add_parser("grep-marked",
-        help="View all entries with given mark that match given regex. \
-                '--mark' option is ignored")
-    grep_marked_parser.add_argument("regex")
-    grep_marked_parser.add_argument("mark")
+    if wanted("grep-marked"):
+        grep_marked_parser = subparsers.add_parser("grep-marked",
+            help="View all entries with given mark that match given regex. \
+                    '--mark' option is ignored")
+        grep_marked_parser.add_argument("regex")
+        grep_marked_parser.add_argument("mark")
+
+    # 'import' command
+    if wanted("import"):
+        import_parser = subparsers.add_parser("import",
+            help="Add many entries at once. Entries with the same date and mark are \
+                    merged, as with 'add'. --date and --mark options are ignored.")
+        import_parser.add_argument("file", nargs="?", default=None,
+            help="file to read entries from, stdin by default")
+        import_parser.add_argument("-f", "--format", dest="format",
+            choices=["jsonl", "tsv"], default="jsonl",
+            help="input format: JSON objects with 'date', 'mark' and 'contents' \
+                    fields, one per line, or tab-separated date, mark and contents \
+                    with '\\n', '\\t' and '\\\\' escapes. Default is jsonl.")
+
+    # 'marks' command
+    if wanted("marks"):
+        marks_parser = subparsers.add_parser("marks",
+            help="List all marks with numbers of entries and dates they span")
+
+    # 'compact' command
+    if wanted("compact"):
+        compact_parser = subparsers.add_parser("compact",
+            help="Merge pending changes into the log file")
+
+    # 'migrate' command
+    if wanted("migrate"):
+        migrate_parser = subparsers.add_parser("migrate",
+            help="Convert the log file to the latest format")
+
+    # 'follow' command
+    if wanted("follow"):
+        follow_parser = subparsers.add_parser("follow",
+            help="Print entries as they are added or changed, until interrupted. \
+                    Options other than the ones below are ignored, except for the \
+                    formatting ones.")
+        follow_parser.add_argument("regex", nargs="?", default=None,
+            help="print only entries matching given regular expression")
+        follow_parser.add_argument("-m", "--mark", dest="only_mark", default=None,
+            help="print only entries with given mark")
+        follow_parser.add_argument("--interval", dest="interval", type=float,
+            default=1.0,
+            help="seconds between checks of the log where inotify is not available. \
+                    Default is 1.")
+
+    # 'export' command
+    if wanted("export"):
+        export_parser = subparsers.add_parser("export",
+            help="Write the entries out for other tools. --before, --after, \
+                    --reverse and --hide options are honored, --date and --mark \
+                    options are ignored.")
+        export_parser.add_argument("file", nargs="?", default=None,
+            help="file to write the entries to, stdout by default. Required for \
+                    sqlite.")
+        export_parser.add_argument("-f", "--format", dest="format",
+            choices=export.FORMATS, default="jsonl",
+            help="output format: JSON objects with 'date', 'mark' and 'contents' \
+                    fields, one per line, as 'import' reads them, CSV with the same \
+                    columns, or an SQLite database with an 'entries' table indexed \
+                    by date and mark and an 'entries_fts' full-text index of the \
+                    contents. Default is jsonl.")
+        export_parser.add_argument("-m", "--mark", dest="only_mark", default=None,
+            help="export only entries with given mark")
+
+    # 'batch' command
+    if wanted("batch"):
+        batch_parser = subparsers.add_parser("batch",
+            help="Answer many queries read from stdin, one per line, reading the \
+                    log once. A query is a 'view', 'view-marked', 'view-all', \
+                    'grep' or 'grep-marked' command with its arguments and -d, -m, \
+                    -b, -a and -r options, as given to simlog. The entries found \
+                    are printed query by query.")
+
+    # 'serve' command
+    if wanted("serve"):
+        serve_parser = subparsers.add_parser("serve",
+            help="Keep the log in memory and answer other invocations of simlog \
+                    over a local socket until interrupted")
 
+    if command is not None:
+        if not subparsers.choices:
+            # not a command at all, let argparse complain about it as usual
+            return build_parser()
+        # errors in the options are reported with the usage of every command
+        parser.error = lambda message: build_parser().error(message)
     return parser
 
+def invoked_command(parser, argv):
+    """
+    Return the command among the arguments, or None if it can't be told
+    without parsing them or the help of all the commands is asked for
+    """
+    options = {s: a for a in parser._actions for s in a.option_strings}
+    args = iter(argv)
+    for arg in args:
+        if not arg.startswith("-") or arg == "-":
+            return arg
+        if arg.startswith("--"):
+            name = arg.split("=", 1)[0]
+            # abbreviations of the options are left to argparse
+            if name not in options or name == "--help":
+                return None
+            if options[name].nargs != 0 and "=" not in arg:
+                next(args, None)
+            continue
+        for i, c in enumerate(arg[1:], 1):
+            action = options.get("-" + c)
+            if action is None or c == "h":
+                return None
+            if action.nargs != 0:
+                if i == len(arg) - 1:
+                    next(args, None)
+                break
+    return None
+
 def main():
     """ Main """
+    start = time.perf_counter()
+    parser = build_parser(sys.argv[1:])
+    args = parser.parse_args()
+    report = args.profile or trace_format(os.environ.get("SIMLOG_TRACE"))
+    dump = args.profile_dump or os.environ.get("SIMLOG_TRACE_DUMP") or None
+    if args.command == "serve":
+        # the daemon parses the arguments of any command
+        serve(build_parser(), args)
+    elif report is not None or dump is not None:
+        # profiled commands are never passed to the daemon
+        profile(args, report, dump, start)
+    elif not forward(args):
+        execute(args)
+
+def profile(args, report, dump, start):
+    """ Run the command, taking measurements along the way """
+    profiling.enable(start)
+    profiling.add_time("parse arguments", time.perf_counter() - start)
+    profiler = None
+    if dump is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
     try:
-        parser = build_parser()
-        args = parser.parse_args()
-        logg = logger.Logger(args)
+        with profiling.phase("total"):
+            execute(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump)
+        if report is not None:
+            profiling.report(report)
+
+def trace_format(value):
+    """
+    Return the report format requested by the value of SIMLOG_TRACE, or None
+    if it's not set
+    """
+    if value in (None, "", "0"):
+        return None
+    return value if value in profiling.FORMATS else "summary"
+
+def execute(args, log=None):
+    """ Run the command described by parsed arguments on given log """
+    try:
+        logg = logger.Logger(args, log)
         logg.ensure_files()
         logg.run()
     except logger.ConfigError:
         print("Invalid configuration detected, terminating.")
     except logger.NoEntryError:
         print("Entry file was not created, nothing will be added to the log.")
+    except entry.EntryReadError as e:
+        print(f"The log file is damaged. {' '.join(e.args)}")
+
+def serve(parser, args):
+    """ Run the daemon answering other invocations """
+    import server
+    try:
+        logg = logger.Logger(args)
+        logg.ensure_files()
+    except logger.ConfigError:
+        print("Invalid configuration detected, terminating.")
+        return
+    log = logg.logfile
+    log.keep_in_memory()
+    daemon = server.Server(logg.logdir / "socket", parser,
+            lambda args: execute(args, log))
+    daemon.run()
+
+def forward(args):
+    """
+    Pass the command to the daemon, if one is running and serves it. Return
+    False if the command has to be run by this process.
+    """
+    socket = logger.log_directory() / "socket"
+    # no daemon runs most of the time, and then there's no need to load
+    # the code talking to it
+    if not socket.exists():
+        return False
+    import server
+    if args.command not in server.SERVED:
+        return False
+    if args.command == "add" and not args.from_stdin:
+        return False
+    stdin = sys.stdin.read() if args.command in ["add", "batch"] else None
+    try:
+        response = server.request(socket, sys.argv[1:], stdin)
+    except (OSError, ValueError, KeyError):
+        print("Lost connection to the daemon, the command may not have been run.")
+        sys.exit(1)
+    if response is None:
+        if stdin is not None:
+            sys.stdin = io.StringIO(stdin)
+        return False
+    output, status = response
+    sys.stdout.write(output)
+    if status != 0:
+        sys.exit(status)
+    return True
+
+def terminal_width():
+    """
+    Return the width of the terminal, the way shutil.get_terminal_size()
+    finds it
+    """
+    try:
+        columns = int(os.environ["COLUMNS"])
+    except (KeyError, ValueError):
+        columns = 0
+    if columns <= 0:
+        try:
+            columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            columns = 0
+    return columns if columns > 0 else 80
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,126 @@
+""" A module for the index of entries' marks """
+
+import array
+import bisect
+import struct
+
+import fsutil
+import profiling
+
+# a mark index file starts with this signature, followed by a stamp of the
+# log's state, just like the offset index
+MAGIC = b"SIMLOGM1"
+STAMP = struct.Struct("=8sQQ")
+COUNT = struct.Struct("=Q")
+# a posting list header: mark's length in bytes and number of entries,
+# followed by the mark, the entries' date ordinals and their offsets
+POSTING = struct.Struct("=QQ")
+
+class MarkIndex():
+    """
+    An index mapping every mark to the list of entries of the log file with
+    this mark. For every entry its date's ordinal and its offset are kept, in
+    the log's order, that is, from the latest entry to the oldest.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.postings = {}
+
+    #--------- persistence ---------#
+
+    def load(self, stamp):
+        """
+        Load the index from disk. Return False if there's no index or if it
+        was built for a different state of the log.
+        """
+        if self.stamp == stamp:
+            return True
+        try:
+            with self.path.open("rb") as f:
+                data = f.read()
+            profiling.count("bytes read", len(data))
+        except FileNotFoundError:
+            return False
+        head_size = STAMP.size + COUNT.size
+        if len(data) < head_size or STAMP.unpack_from(data, 0) != (MAGIC, *stamp):
+            return False
+        count, = COUNT.unpack_from(data, STAMP.size)
+        pos = head_size
+        postings = {}
+        try:
+            for _ in range(count):
+                mark_len, n = POSTING.unpack_from(data, pos)
+                pos += POSTING.size
+                mark = data[pos : pos + mark_len].decode("utf-8")
+                pos += mark_len
+                ordinals, offsets = array.array("I"), array.array("Q")
+                ordinals.frombytes(data[pos : pos + n * ordinals.itemsize])
+                pos += n * ordinals.itemsize
+                offsets.frombytes(data[pos : pos + n * offsets.itemsize])
+                pos += n * offsets.itemsize
+                postings[mark] = ordinals, offsets
+        except (struct.error, UnicodeDecodeError, ValueError):
+            return False
+        self.postings, self.stamp = postings, stamp
+        return True
+
+    def save(self, stamp):
+        """ Write the index to disk, marking it as built for given log state """
+        chunks = [STAMP.pack(MAGIC, *stamp), COUNT.pack(len(self.postings))]
+        for mark, (ordinals, offsets) in self.postings.items():
+            key = bytes(mark, "utf-8")
+            chunks.append(POSTING.pack(len(key), len(ordinals)))
+            chunks.append(key)
+            chunks.append(ordinals.tobytes())
+            chunks.append(offsets.tobytes())
+        data = b"".join(chunks)
+        fsutil.replace_file(self.path, lambda f: f.write(data), sync=False)
+        self.stamp = stamp
+
+    def restamp(self, old, new):
+        """
+        Mark the index built for the 'old' state of the log as built for the
+        'new' one, after a change that left every entry's date, mark and
+        offset intact
+        """
+        if fsutil.patch_head(self.path, STAMP.pack(MAGIC, *old), STAMP.pack(MAGIC, *new)):
+            if self.stamp == old:
+                self.stamp = new
+
+    #--------- modification ---------#
+
+    def rebuild(self, records):
+        """
+        Replace the contents of the index with given (date, mark, offset)
+        triples. The triples must come in the log's order.
+        """
+        postings = {}
+        for date, mark, offset in records:
+            posting = postings.get(mark)
+            if posting is None:
+                posting = postings[mark] = array.array("I"), array.array("Q")
+            posting[0].append(date.toordinal())
+            posting[1].append(offset)
+        self.postings, self.stamp = postings, None
+
+    #--------- lookup ---------#
+
+    def offsets(self, mark, before=None, after=None):
+        """
+        Return a list of offsets of the entries with given mark made within
+        given interval, from the latest to the oldest
+        """
+        posting = self.postings.get(mark)
+        if posting is None:
+            return []
+        ordinals, offsets = posting
+        lo, hi = 0, len(ordinals)
+        if before is not None:
+            lo = bisect.bisect_left(ordinals, -before.toordinal() + 1,
+                    key=lambda o: -o)
+        if after is not None:
+            hi = bisect.bisect_left(ordinals, -after.toordinal(), lo,
+                    key=lambda o: -o)
+        return offsets[lo:hi]
@@ -0,0 +1,36 @@
+""" A module for buffered output of the entries """
+
+import sys
+
+import profiling
+
+class Output():
+    """
+    A writer collecting printed entries and passing them to the underlying
+    stream in large chunks, instead of a write per entry
+    """
+
+    def __init__(self, stream=None, limit=1 << 16):
+        self.stream = stream
+        self.limit = limit
+        self.chunks = []
+        self.size = 0
+
+    def write(self, s):
+        """ Queue a string for writing """
+        self.chunks.append(s)
+        self.size += len(s)
+        if self.size >= self.limit:
+            self.flush()
+
+    @profiling.timed("write output")
+    def flush(self):
+        """ Write out everything queued so far """
+        if self.chunks:
+            stream = self.stream or sys.stdout
+            data = "".join(self.chunks)
+            stream.write(data)
+            profiling.count("characters printed", len(data))
+            stream.flush()
+            self.chunks.clear()
+            self.size = 0
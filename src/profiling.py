@@ -0,0 +1,118 @@
+""" A module for measuring where the time of a simlog invocation goes """
+
+import contextlib
+import functools
+import os
+import sys
+import time
+
+# report formats
+FORMATS = ["summary", "json"]
+
+# whether measurements are being taken. While it is False, all the hooks
+# return immediately.
+enabled = False
+# wall time of phases: name -> [seconds, number of times entered]
+phases = {}
+# counters of bytes and entries: name -> value
+counters = {}
+
+def enable(since=None):
+    """
+    Start taking measurements. The time from the start of the process until
+    'since', a value of time.perf_counter(), or until now is accounted as the
+    startup phase.
+    """
+    global enabled
+    enabled = True
+    age = process_age()
+    if age is not None:
+        if since is not None:
+            age -= time.perf_counter() - since
+        phases["startup"] = [max(0.0, age), 1]
+
+def add_time(name, seconds):
+    """ Account time spent in a phase """
+    phase = phases.get(name)
+    if phase is None:
+        phases[name] = [seconds, 1]
+    else:
+        phase[0] += seconds
+        phase[1] += 1
+
+@contextlib.contextmanager
+def phase(name):
+    """ Measure the time spent in a 'with' block as a phase """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+def timed(name):
+    """
+    Decorate a function so that the time spent in it is measured as a phase.
+    Generator functions are not to be decorated, their time would only cover
+    creation of the generator.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+def count(name, n=1):
+    """ Increase a counter """
+    if enabled:
+        counters[name] = counters.get(name, 0) + n
+
+#--------- reporting ---------#
+
+def report(fmt="summary", stream=None):
+    """ Write the measurements to a stream, stderr by default """
+    stream = stream or sys.stderr
+    if fmt == "json":
+        import json
+        data = {
+            "phases": {name: {"seconds": seconds, "calls": calls}
+                for name, (seconds, calls) in phases.items()},
+            "counters": counters,
+        }
+        stream.write(json.dumps(data) + "\n")
+        return
+    lines = ["-- simlog profile --"]
+    width = max(map(len, [*phases, *counters]), default=0)
+    for name, (seconds, calls) in phases.items():
+        lines.append(f"{name:<{width}}  {seconds * 1000:10.2f} ms  {calls:>8} calls")
+    for name, value in counters.items():
+        lines.append(f"{name:<{width}}  {value:>13}")
+    stream.write("\n".join(lines) + "\n")
+
+#--------- helper functions ---------#
+
+def process_age():
+    """
+    Return the number of seconds since the start of this process, or None if
+    the system doesn't tell. The resolution is that of the kernel's clock
+    ticks, usually 10 ms.
+    """
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # the process' name may contain spaces, the fields after it don't
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        started = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError, AttributeError):
+        return None
+    return uptime - started
@@ -0,0 +1,252 @@
+""" A module for matching entries' contents, in one process or in many """
+
+import mmap
+import os
+import re
+
+import formats
+import trigrams
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# rough costs of matching a record of a typical log and of starting a worker
+# process, in seconds. A search is only made in parallel if the time it saves
+# outweighs the time spent starting the workers, which takes some 40000
+# records for two workers and 53000 for four.
+RECORD_SECONDS = 10e-6
+WORKER_SECONDS = 0.1
+# every worker gets this many ranges on average, so that a range full of long
+# entries doesn't keep one worker busy while the others are idle
+RANGES_PER_JOB = 4
+
+# the log file as mapped by a worker process
+mapped = None
+
+# characters 'grep' joins the lines by or splits the contents at. A pattern
+# that can match none of them never matches across lines.
+SEPARATORS = " \n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+# line breaks other than '\n', which '^' and '$' don't see as such
+OTHER_BREAKS = re.compile("[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+# regexes matching the characters of the categories like '\s'
+CATEGORIES = {
+    sre_parse.CATEGORY_DIGIT: r"\d",
+    sre_parse.CATEGORY_NOT_DIGIT: r"\D",
+    sre_parse.CATEGORY_SPACE: r"\s",
+    sre_parse.CATEGORY_NOT_SPACE: r"\S",
+    sre_parse.CATEGORY_WORD: r"\w",
+    sre_parse.CATEGORY_NOT_WORD: r"\W",
+}
+
+class Pattern():
+    """
+    What 'grep' looks for in the entries: a regex or, with 'fixed', a plain
+    string, optionally ignoring case. The contents match if the pattern is
+    found with their lines joined by spaces or in any single line.
+
+    Most patterns can't match across lines, and for them this is the same
+    as searching the contents as they are, with '^' and '$' matching at line
+    breaks, which is what is done. The lines are only joined for patterns
+    that can match a space or a line break, such as 'foo bar', and for the
+    ones with lookarounds, '\\A', '\\B' or '\\Z'.
+
+    Raises re.error if the regex is invalid.
+    """
+
+    def __init__(self, text, fixed=False, ignore_case=False):
+        self.text = text
+        self.fixed = fixed
+        self.ignore_case = ignore_case
+        self.key = (text, fixed, ignore_case)
+        flags = re.IGNORECASE if ignore_case else 0
+        if fixed:
+            self.needle = text.lower() if ignore_case else text
+            self.regex = re.compile(re.escape(text), flags)
+            self.joined = any(c in SEPARATORS for c in text)
+            self.anchored = False
+            self.line_local = True
+        else:
+            self.regex = re.compile(text, flags | re.MULTILINE)
+            self.joined, self.anchored, self.line_local = analyze(self.regex)
+        self.literals = trigrams.required_literals(self.regex)
+
+    def matches(self, contents):
+        """ Return True if the contents match the pattern """
+        if self.fixed:
+            return self.contains(contents)
+        if self.joined or self.anchored and OTHER_BREAKS.search(contents):
+            return self.matches_lines(contents)
+        if not all(literal in contents for literal in self.literals):
+            return False
+        # a trailing line break doesn't start another line
+        end = len(contents) - 1 if contents.endswith("\n") else len(contents)
+        return self.regex.search(contents, 0, end) is not None
+
+    def contains(self, contents):
+        """ Return True if the contents contain the fixed string """
+        if self.ignore_case:
+            contents = contents.lower()
+        if self.joined:
+            contents = " ".join(contents.splitlines())
+        return self.needle in contents
+
+    def matches_lines(self, contents):
+        """
+        Return True if the pattern is found with the lines of the contents
+        joined by spaces or in any single line
+        """
+        lines = contents.splitlines()
+        single_line = " ".join(lines)
+        if not all(literal in single_line for literal in self.literals):
+            return False
+        if self.regex.search(single_line):
+            return True
+        # without anchors and lookarounds a match in a line is also a match
+        # in the joined lines
+        if not self.anchored and self.line_local:
+            return False
+        return any(self.regex.search(line) for line in lines)
+
+def parallel_jobs(records, jobs):
+    """
+    Return the number of processes worth searching given number of records
+    with, at most 'jobs' and no more than the CPUs available, or 1 if the
+    search is better made by a single process
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    jobs = min(jobs, cpus)
+    while jobs > 1:
+        saved = records * RECORD_SECONDS * (1 - 1 / jobs)
+        if saved > jobs * WORKER_SECONDS:
+            return jobs
+        jobs -= 1
+    return 1
+
+def split(offsets, lo, hi, parts):
+    """
+    Split the records with positions from 'lo' to 'hi' in a sorted list of
+    records' offsets into at most given number of ranges of consecutive
+    records. Return a list of (start, end) pairs, where 'end' is the offset of
+    the first record after the range, or None if there's no such record.
+    """
+    count = hi - lo
+    parts = max(1, min(parts, count))
+    bounds = [lo + count * i // parts for i in range(parts + 1)]
+    return [(offsets[start], offsets[end] if end < len(offsets) else None)
+            for start, end in zip(bounds, bounds[1:]) if start < end]
+
+def parallel_search(path, ranges, pattern, mark, jobs):
+    """
+    Search given ranges of the log file in a pool of worker processes. Return
+    a list of offsets of the records matching a pattern, in the log's order.
+    """
+    import multiprocessing
+    tasks = [(start, end, pattern, mark) for start, end in ranges]
+    with multiprocessing.Pool(jobs, initializer=map_log, initargs=(path,)) as pool:
+        found = pool.map(search_range, tasks, chunksize=1)
+    return [offset for offsets in found for offset in offsets]
+
+#--------- worker functions ---------#
+
+def map_log(path):
+    """ Map the log file into a worker's memory """
+    global mapped
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def search_range(task):
+    """
+    Return a list of offsets of the records in a range of the log file that
+    match a pattern
+    """
+    start, end, pattern, mark = task
+    layout = formats.detect(mapped)
+    buf = memoryview(mapped)
+    found = []
+    try:
+        for offset, _, rec_mark, cont_at, rec_end, extra in layout.walk(buf, start):
+            if end is not None and offset >= end:
+                break
+            if mark is not None and rec_mark != mark:
+                continue
+            if pattern.matches(layout.contents(buf, cont_at, rec_end, extra)):
+                found.append(offset)
+    finally:
+        buf.release()
+    return found
+
+#--------- helper functions ---------#
+
+def analyze(regex):
+    """
+    Return a triple of flags telling whether a compiled regex has to be
+    matched against the joined lines, whether it has '^' or '$' in it, and
+    whether it has no assertions other than these and '\\b' in it. A regex
+    has to be matched against the joined lines if it can match a space or a
+    line break or has other assertions. Anything not understood counts as
+    such.
+    """
+    parsed = sre_parse.parse(regex.pattern, regex.flags)
+    flags = parsed.state.flags
+    found = {"separator": False, "anchor": False, "assertion": False}
+    def consumes(op, arg):
+        if op is sre_parse.LITERAL:
+            return chr(arg) in SEPARATORS
+        if op is sre_parse.NOT_LITERAL or op is sre_parse.ANY:
+            return True
+        if op is sre_parse.IN:
+            return any(in_class(arg, c, flags) for c in SEPARATORS)
+        return None
+    def scan(items):
+        for op, arg in items:
+            consumed = consumes(op, arg)
+            if consumed is not None:
+                found["separator"] |= consumed
+            elif op is sre_parse.AT:
+                if arg in (sre_parse.AT_BEGINNING, sre_parse.AT_END):
+                    found["anchor"] = True
+                elif arg is not sre_parse.AT_BOUNDARY:
+                    # including '\B', which never matches an empty line
+                    found["assertion"] = True
+            elif op is sre_parse.SUBPATTERN:
+                scan(arg[3])
+            elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) or \
+                    op is getattr(sre_parse, "POSSESSIVE_REPEAT", None):
+                scan(arg[2])
+            elif op is getattr(sre_parse, "ATOMIC_GROUP", None):
+                scan(arg)
+            elif op is sre_parse.BRANCH:
+                for branch in arg[1]:
+                    scan(branch)
+            elif op is sre_parse.GROUPREF_EXISTS:
+                scan(arg[1])
+                if arg[2] is not None:
+                    scan(arg[2])
+            elif op is not sre_parse.GROUPREF:
+                found["assertion"] = True
+    scan(parsed)
+    line_local = not found["assertion"]
+    return found["separator"] or not line_local, found["anchor"], line_local
+
+def in_class(items, char, flags):
+    """ Return whether a character is in a parsed character class """
+    negate = False
+    found = False
+    for op, arg in items:
+        if op is sre_parse.NEGATE:
+            negate = True
+        elif op is sre_parse.LITERAL:
+            found |= char == chr(arg)
+        elif op is sre_parse.RANGE:
+            found |= arg[0] <= ord(char) <= arg[1]
+        elif op is sre_parse.CATEGORY:
+            found |= re.fullmatch(CATEGORIES[arg], char, flags & re.ASCII) is not None
+        else:
+            # not understood, assume the worst
+            return True
+    return found != negate
@@ -0,0 +1,139 @@
+""" A module for the daemon answering commands over a local socket """
+
+# the client is loaded by most invocations of simlog, so the modules only the
+# daemon or a connection to it needs are imported where they are used
+
+import contextlib
+import io
+import os
+import sys
+
+# commands the daemon answers. The rest either need a terminal for EDITOR or
+# rewrite the whole log, and gain nothing from a warm process.
+SERVED = ["view", "view-all", "view-marked", "grep", "grep-marked", "marks",
+        "remove", "remove-marked", "add", "batch"]
+
+#--------- daemon ---------#
+
+class Server():
+    """
+    A daemon listening on a Unix domain socket. Every connection carries a
+    single request: a JSON object with 'argv', the command line arguments of
+    simlog, and optionally 'stdin', the text to be used as standard input. The
+    daemon answers with a JSON object with 'output', the text the command
+    printed, and 'status', its exit status.
+
+    Requests are served one at a time, so that commands never interleave
+    their output or their changes.
+    """
+
+    def __init__(self, path, parser, execute):
+        self.path = path
+        self.parser = parser
+        self.execute = execute
+
+    def run(self):
+        """ Serve requests until interrupted """
+        if request(self.path, ["--help"]) is not None:
+            print(f"Another daemon is already listening on {self.path}.")
+            return
+        import asyncio
+        asyncio.run(self.listen())
+
+    async def listen(self):
+        """ Accept connections until SIGINT or SIGTERM is received """
+        import asyncio
+        import signal
+        if self.path.exists() or self.path.is_symlink():
+            # left over by a daemon that was killed
+            self.path.unlink()
+        server = await asyncio.start_unix_server(self.handle, path=str(self.path))
+        os.chmod(self.path, 0o600)
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                self.path.unlink()
+
+    async def handle(self, reader, writer):
+        """ Answer a single request """
+        import json
+        try:
+            req = json.loads(await reader.read())
+            response = self.answer(req["argv"], req.get("stdin"))
+        except (ValueError, KeyError, TypeError):
+            response = {"output": "Malformed request.\n", "status": 2}
+        writer.write(bytes(json.dumps(response), "utf-8"))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def answer(self, argv, stdin=None):
+        """ Run a command, returning a response with its output """
+        out = io.StringIO()
+        status = 0
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out), \
+                replaced_stdin(stdin):
+            try:
+                args = self.parser.parse_args(argv)
+                if args.command in SERVED:
+                    self.execute(args)
+                else:
+                    print(f"The daemon doesn't serve '{args.command}' command.")
+                    status = 2
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else 1
+        return {"output": out.getvalue(), "status": status}
+
+#--------- client ---------#
+
+def request(path, argv, stdin=None):
+    """
+    Send a command to the daemon listening on given socket. Return a pair of
+    the command's output and its exit status, or None if no daemon is
+    listening there.
+    """
+    if not os.path.exists(path):
+        return None
+    import json
+    import socket
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    data = bytes(json.dumps({"argv": argv, "stdin": stdin}), "utf-8")
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(path))
+        except (FileNotFoundError, ConnectionRefusedError):
+            return None
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    response = json.loads(b"".join(chunks))
+    return response["output"], response["status"]
+
+#--------- helper functions ---------#
+
+@contextlib.contextmanager
+def replaced_stdin(text):
+    """ Make the standard input read given text, if it isn't None """
+    if text is None:
+        yield
+        return
+    old = sys.stdin
+    sys.stdin = io.StringIO(text)
+    try:
+        yield
+    finally:
+        sys.stdin = old
@@ -0,0 +1,354 @@
+""" A module for the log split into shards by time period """
+
+import datetime
+
+import formats
+import fsutil
+import locking
+import logfile
+import storage
+
+# shards hold the entries made within a month or within a year
+PERIODS = ["month", "year"]
+
+class ShardedLog(storage.Storage):
+    """
+    A log split into shards, one per month or year, each of them an ordinary
+    Logfile with its own delta log and indices. The shards of a log at
+    '~/.simlog/log' are '~/.simlog/log.YYYY-MM' or '~/.simlog/log.YYYY'.
+
+    A manifest next to the shards keeps, for every shard, its mark catalog:
+    the number of entries with every mark and the dates of the oldest and the
+    latest of them. Changes touch only the shard for the entry's date, and
+    queries skip the shards whose catalog shows they hold no entry made
+    within given interval and with given mark. Every shard's entry in the
+    manifest is stamped with the state of the shard's files, and is rebuilt
+    if a shard was changed without the manifest being updated, say by a
+    process that died in between.
+
+    A single lock covers all the shards and the manifest.
+    """
+
+    def __init__(self, path, period, durability="always", compress=False):
+        self.path = path
+        self.period = period
+        self.durability = durability
+        self.compress = compress
+        self.lock = locking.FileLock(path.with_name(path.name + ".lock"))
+        self.manifest_path = path.with_name(path.name + ".manifest")
+        self.manifest = {}
+        self.memory = False
+        # open shards by their names
+        self.shards = {}
+
+    def ensure_existence(self):
+        """ Create the manifest if it doesn't exist """
+        with self.lock.held(exclusive=True):
+            if not self.manifest_path.exists():
+                self.save_manifest()
+
+    def recover(self):
+        """ Clean up after interrupted rewrites of the shards """
+        with self.lock.held(exclusive=True, blocking=False) as acquired:
+            if acquired:
+                for tmp in self.path.parent.glob(self.path.name + "*" + fsutil.TEMP_SUFFIX):
+                    tmp.unlink()
+
+    def keep_in_memory(self):
+        """
+        Keep decoded entries of the shards in memory between calls. Meant for
+        long-running processes.
+        """
+        self.memory = True
+        for shard in self.shards.values():
+            shard.keep_in_memory()
+
+    def segments(self):
+        """ Return a list of the shards, from the oldest to the latest """
+        self.load_manifest()
+        return [self.shard(name) for name in sorted(self.manifest)]
+
+    def files(self):
+        """ Return a list of the files holding the entries """
+        return [self.manifest_path, *(path for shard in self.segments()
+                for path in shard.files())]
+
+    def load(self, entries):
+        """
+        Replace the entries of the log with given ones. The shards listed in
+        the manifest before, even if the log was sharded by another period,
+        are removed once the manifest lists the new ones.
+        """
+        with self.lock.held(exclusive=True):
+            old = self.segments() if self.manifest_path.exists() else []
+            groups = {}
+            for e in entries:
+                groups.setdefault(self.shard_name(e.date), []).append(e)
+            self.manifest = {}
+            for name, group in groups.items():
+                shard = self.shard(name)
+                shard.load(group)
+                self.manifest[name] = summary(shard)
+            self.save_manifest()
+            for shard in old:
+                if shard.path.name not in groups:
+                    shard.destroy()
+
+    def destroy(self):
+        """
+        Remove the shards and the manifest, unless the log was resharded by
+        another period in the meantime
+        """
+        if manifest_period(self.manifest_path) != self.period:
+            return
+        for shard in self.segments():
+            shard.destroy()
+        self.manifest_path.unlink()
+
+    #--------- shards and the manifest ---------#
+
+    def shard_name(self, date):
+        """ Return the name of the shard holding the entries made on a date """
+        if self.period == "year":
+            return f"{self.path.name}.{date.year:04}"
+        return f"{self.path.name}.{date.year:04}-{date.month:02}"
+
+    def shard(self, name, create=False):
+        """ Return the shard with given name, creating it if asked to """
+        shard = self.shards.get(name)
+        if shard is None:
+            shard = logfile.Logfile(self.path.with_name(name), self.durability,
+                    self.compress)
+            shard.lock = self.lock
+            if self.memory:
+                shard.keep_in_memory()
+            self.shards[name] = shard
+        if create:
+            shard.ensure_existence()
+        return shard
+
+    def load_manifest(self):
+        """
+        Read the manifest, rebuilding the entries of the shards that were
+        changed since they were recorded
+        """
+        import json
+        try:
+            with self.manifest_path.open("r") as f:
+                manifest = json.load(f)["shards"]
+        except FileNotFoundError:
+            manifest = {}
+        stale = False
+        for name in list(manifest):
+            stamp = self.shard(name).stamps()
+            if stamp is None:
+                del manifest[name]
+                stale = True
+            elif stamp != manifest[name]["stamp"]:
+                manifest[name] = summary(self.shard(name))
+                stale = True
+        self.manifest = manifest
+        if stale:
+            self.save_manifest()
+        return manifest
+
+    def save_manifest(self):
+        """ Write the manifest to disk """
+        import json
+        data = json.dumps({"period": self.period, "shards": self.manifest},
+                sort_keys=True)
+        fsutil.replace_file(self.manifest_path,
+                lambda f: f.write(bytes(data, "utf-8")),
+                self.durability != "never")
+
+    def update(self, names):
+        """ Record the current state of given shards in the manifest """
+        for name in names:
+            self.manifest[name] = summary(self.shard(name))
+        self.save_manifest()
+
+    def select(self, before=None, after=None, mark=None, reverse=False):
+        """
+        Return a list of the shards which may hold entries made within given
+        interval and with given mark, if it's not None, from the latest to the
+        oldest, or in reverse order if 'reverse' is True
+        """
+        self.load_manifest()
+        before = before and before.toordinal()
+        after = after and after.toordinal()
+        names = []
+        for name in sorted(self.manifest, reverse=not reverse):
+            marks = self.manifest[name]["marks"]
+            spans = marks.values() if mark is None else [marks.get(mark)]
+            for span in spans:
+                if span is None:
+                    continue
+                _, oldest, latest = span
+                if (before is None or oldest < before) and (after is None or latest > after):
+                    names.append(name)
+                    break
+        return [self.shard(name) for name in names]
+
+    #--------- writing to the log ---------#
+
+    @logfile.exclusive
+    def prepend(self, e):
+        """ Place the entry in the head of its shard """
+        self.change(e.date, lambda shard: shard.prepend(e))
+
+    @logfile.exclusive
+    def replace(self, new_e):
+        """ Replace the entry with the same date and mark as the given one """
+        self.change(new_e.date, lambda shard: shard.replace(new_e))
+
+    @logfile.exclusive
+    def insert_by_date(self, new_e):
+        """ Insert the new entry in between old ones """
+        self.change(new_e.date, lambda shard: shard.insert_by_date(new_e))
+
+    @logfile.exclusive
+    def remove(self, date, mark):
+        """ Remove specific entry from the log """
+        self.change(date, lambda shard: shard.remove(date, mark), create=False)
+
+    def change(self, date, action, create=True):
+        """
+        Apply an action to the shard holding the entries made on a date. The
+        shard is created if it doesn't exist and 'create' is True.
+        """
+        name = self.shard_name(date)
+        if name not in self.load_manifest() and not create:
+            return
+        self.add_shard(name)
+        action(self.shard(name))
+        self.update([name])
+
+    def add_shard(self, name):
+        """
+        Create a shard if it doesn't exist. New shards are listed in the
+        manifest before anything is written to them, so that their entries
+        are never lost.
+        """
+        self.shard(name, create=True)
+        if name not in self.manifest:
+            self.update([name])
+
+    @logfile.exclusive
+    def remove_several(self, predicate, before=None, after=None, mark=None):
+        """
+        Remove all entries such that predicate(entry) is True. If 'mark' is
+        not None, only entries with this mark are considered.
+        """
+        names = []
+        for shard in self.select(before, after, mark):
+            shard.remove_several(predicate, before, after, mark)
+            names.append(shard.path.name)
+        self.update(names)
+
+    @logfile.exclusive
+    def import_entries(self, entries):
+        """
+        Merge many entries into the log, rewriting only the shards they fall
+        into
+        """
+        self.load_manifest()
+        groups = {}
+        for e in entries:
+            groups.setdefault(self.shard_name(e.date), []).append(e)
+        for name, group in groups.items():
+            self.add_shard(name)
+            self.shard(name).import_entries(group)
+        self.update(groups)
+
+    @logfile.exclusive
+    def compact(self):
+        """ Merge the delta logs into the shards, dropping the empty shards """
+        for shard in self.segments():
+            name = shard.path.name
+            shard.compact()
+            self.manifest[name] = summary(shard)
+            if not self.manifest[name]["marks"]:
+                del self.manifest[name]
+                del self.shards[name]
+                self.save_manifest()
+                shard.destroy()
+        self.save_manifest()
+
+    @logfile.exclusive
+    def migrate(self):
+        """ Convert the shards to the latest layout """
+        names = []
+        for shard in self.segments():
+            shard.migrate()
+            names.append(shard.path.name)
+        self.update(names)
+
+    def version(self):
+        """ Return the oldest version of the layouts of the shards """
+        return min((shard.version() for shard in self.segments()),
+                default=max(formats.LAYOUTS))
+
+    #--------- querying entries ---------#
+
+    @logfile.shared
+    def merged_entries(self, before=None, after=None, mark=None, reverse=False):
+        """
+        Return an iterator of all the entries, from the latest to the oldest,
+        or in reverse order if 'reverse' is True
+        """
+        for shard in self.select(before, after, mark, reverse):
+            yield from shard.merged_entries(before, after, mark, reverse)
+
+    @logfile.shared
+    def grep(self, pattern, before=None, after=None, mark=None, reverse=False,
+            jobs=1):
+        """ Return an iterator with all entries matching given search.Pattern """
+        for shard in self.select(before, after, mark, reverse):
+            yield from shard.grep(pattern, before, after, mark, reverse, jobs)
+
+    @logfile.shared
+    def mark_catalog(self):
+        """
+        Return a dict mapping every mark in the log to a triple of the number
+        of entries with this mark and the dates of the oldest and the latest
+        of them. It is computed from the manifest alone.
+        """
+        catalog = {}
+        for info in self.load_manifest().values():
+            for mark, (count, oldest, latest) in info["marks"].items():
+                if mark in catalog:
+                    total, first, last = catalog[mark]
+                    count, oldest, latest = (total + count, min(first, oldest),
+                            max(last, latest))
+                catalog[mark] = count, oldest, latest
+        return {mark: (count, datetime.date.fromordinal(oldest),
+                datetime.date.fromordinal(latest))
+                for mark, (count, oldest, latest) in catalog.items()}
+
+    @logfile.shared
+    def find_specific(self, date, mark=""):
+        """
+        Return an entry with given date and mark, or None if such an entry does
+        not exist.
+        """
+        name = self.shard_name(date)
+        if name not in self.load_manifest():
+            return None
+        return self.shard(name).find_specific(date, mark)
+
+#--------- helper functions ---------#
+
+def summary(shard):
+    """ Return the manifest's entry for a shard """
+    catalog = shard.mark_catalog()
+    return {
+        "stamp": shard.stamps(),
+        "marks": {mark: [count, oldest.toordinal(), latest.toordinal()]
+            for mark, (count, oldest, latest) in catalog.items()},
+    }
+
+def manifest_period(path):
+    """ Return the period of the shards listed in a manifest """
+    import json
+    with path.open("r") as f:
+        return json.load(f)["period"]
@@ -0,0 +1,427 @@
+""" A module for the log stored in an SQLite database """
+
+import contextlib
+import datetime
+import os
+
+import entry
+import fsutil
+import locking
+import logfile
+import profiling
+import storage
+
+# the database's schema. Contents are indexed for 'grep' in the form they are
+# matched against, with the lines joined by spaces, and 'seq' numbers the
+# changes for 'follow' command. The single row of 'changes' holds the number of
+# the latest change, removals included, so the numbers are never reused. The
+# entries made on the same day are ordered by their rowids, the latest added
+# first, as in the binary log.
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS entries (
+        date TEXT NOT NULL,
+        mark TEXT NOT NULL,
+        contents TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        PRIMARY KEY (date, mark))""",
+    "CREATE INDEX IF NOT EXISTS entries_by_date ON entries (date)",
+    "CREATE INDEX IF NOT EXISTS entries_by_mark ON entries (mark, date)",
+    "CREATE INDEX IF NOT EXISTS entries_by_seq ON entries (seq)",
+    "CREATE TABLE IF NOT EXISTS changes (seq INTEGER NOT NULL)",
+]
+FULL_TEXT = """CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(text,
+        tokenize='trigram')"""
+
+# SQLite's synchronous setting for every durability level
+SYNCHRONOUS = {"always": "FULL", "batched": "NORMAL", "never": "OFF"}
+
+# rows written in a single transaction by bulk loads
+BATCH = 1000
+
+class SqliteLog(storage.Storage):
+    """
+    A log kept in an SQLite database at '~/.simlog/log.db', in WAL mode, so
+    that readers never wait for writers. The entries are keyed by their dates
+    and marks, so adding, editing and removing an entry changes a single
+    row. Marks are indexed, and the contents have a full-text trigram index,
+    which narrows down the candidates for 'grep' the same way the trigram
+    index of the binary log does. Without FTS5, 'grep' checks every entry.
+
+    Changes hold the log's lock in exclusive mode, just like the binary log's,
+    so that commands reading and then changing an entry stay atomic. Queries
+    rely on SQLite's own snapshots instead. Compression doesn't apply.
+    """
+
+    def __init__(self, path, durability="always", compress=False):
+        self.path = path
+        self.durability = durability
+        self.compress = compress
+        self.lock = locking.FileLock(path.with_name(path.name + ".lock"))
+        self.db_path = path.with_name(path.name + ".db")
+        self.db = None
+        self.full_text = False
+
+    def connect(self):
+        """ Return the connection to the database, opening it if needed """
+        if self.db is None:
+            import sqlite3
+            db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute(f"PRAGMA synchronous = {SYNCHRONOUS[self.durability]}")
+            for statement in SCHEMA:
+                db.execute(statement)
+            if db.execute("SELECT count(*) FROM changes").fetchone() == (0,):
+                # databases made before the changes were counted go on from
+                # their latest change
+                db.execute("""INSERT INTO changes (seq)
+                        SELECT coalesce(max(seq), 0) FROM entries""")
+            try:
+                db.execute(FULL_TEXT)
+                self.full_text = True
+            except sqlite3.OperationalError:
+                self.full_text = False
+            self.db = db
+        return self.db
+
+    def ensure_existence(self):
+        """ Create the database if it doesn't exist """
+        self.connect()
+
+    def recover(self):
+        """ Clean up after interrupted conversions """
+        with self.lock.held(exclusive=True, blocking=False) as acquired:
+            if acquired:
+                for tmp in self.path.parent.glob(self.db_path.name + "*" + fsutil.TEMP_SUFFIX):
+                    tmp.unlink()
+
+    def keep_in_memory(self):
+        """ Do nothing: SQLite caches the database on its own """
+
+    def segments(self):
+        """ Return a list of the logs the entries are kept in """
+        return [self]
+
+    def files(self):
+        """ Return a list of the files holding the entries """
+        return [self.db_path, self.db_path.with_name(self.db_path.name + "-wal")]
+
+    def load(self, entries):
+        """
+        Replace the entries of the log with given ones. A new database is
+        built in a temporary file and moved in place once it's complete.
+        """
+        tmp = fsutil.temp_path(self.db_path)
+        if tmp.exists():
+            tmp.unlink()
+        # the changes of the new database are numbered after the old ones
+        seq = self.saved_seq()
+        self.close()
+        try:
+            self.db_path, path = tmp, self.db_path
+            try:
+                db = self.connect()
+                db.execute("UPDATE changes SET seq = ?", (seq,))
+                # the rowids count down, so that the entries keep their order
+                rows = []
+                rowid = -1
+                for e in entries:
+                    rows.append(e)
+                    if len(rows) >= BATCH:
+                        with transaction(db):
+                            self.put_many(rows, rowid)
+                        rowid -= len(rows)
+                        rows.clear()
+                with transaction(db):
+                    self.put_many(rows, rowid)
+                db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                self.close()
+                self.db_path = path
+            self.destroy()
+            os.replace(tmp, self.db_path)
+        except BaseException:
+            for leftover in [tmp, tmp.with_name(tmp.name + "-wal"),
+                    tmp.with_name(tmp.name + "-shm")]:
+                if leftover.exists():
+                    leftover.unlink()
+            raise
+
+    def saved_seq(self):
+        """
+        Return the number of the latest change in the database, or 0 if there's
+        no database. A missing database isn't created: it would be taken for
+        the log, should a conversion into it be interrupted.
+        """
+        if not self.db_path.exists():
+            return 0
+        import sqlite3
+        db = sqlite3.connect(self.db_path.as_uri() + "?mode=ro", uri=True)
+        try:
+            return last_seq(db)
+        except sqlite3.OperationalError:
+            # the database was made before the changes were counted
+            seq, = db.execute("SELECT coalesce(max(seq), 0) FROM entries").fetchone()
+            return seq
+        finally:
+            db.close()
+
+    def destroy(self):
+        """ Remove the database """
+        self.close()
+        for path in [self.db_path, self.db_path.with_name(self.db_path.name + "-wal"),
+                self.db_path.with_name(self.db_path.name + "-shm")]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """ Close the connection to the database """
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    #--------- writing to the log ---------#
+
+    def prepend(self, e):
+        """ Add the entry to the log """
+        self.replace(e)
+
+    def insert_by_date(self, new_e):
+        """ Add the entry to the log """
+        self.replace(new_e)
+
+    @logfile.exclusive
+    @profiling.timed("record changes")
+    def replace(self, new_e):
+        """ Add or replace the entry with the same date and mark as the given one """
+        with transaction(self.connect()):
+            self.put_many([new_e])
+
+    def put_many(self, entries, first_rowid=None):
+        """
+        Add or replace entries, inside a transaction. An entry added goes ahead
+        of the entries made on the same day, unless 'first_rowid' is given: then
+        the entries added get the rowids counting down from it, and are ordered
+        the way they are given.
+        """
+        db = self.connect()
+        seq = last_seq(db)
+        new_rowid = first_rowid
+        for e in entries:
+            seq += 1
+            date = e.date.isoformat()
+            row = db.execute("SELECT rowid FROM entries WHERE date = ? AND mark = ?",
+                    (date, e.mark)).fetchone()
+            if row is None:
+                cursor = db.execute("""INSERT INTO entries (rowid, date, mark,
+                        contents, seq) VALUES (?, ?, ?, ?, ?)""",
+                        (new_rowid, date, e.mark, e.contents, seq))
+                rowid = cursor.lastrowid
+                if new_rowid is not None:
+                    new_rowid -= 1
+            else:
+                rowid, = row
+                db.execute("UPDATE entries SET contents = ?, seq = ? WHERE rowid = ?",
+                        (e.contents, seq, rowid))
+                if self.full_text:
+                    db.execute("DELETE FROM entries_fts WHERE rowid = ?", (rowid,))
+            if self.full_text:
+                db.execute("INSERT INTO entries_fts (rowid, text) VALUES (?, ?)",
+                        (rowid, " ".join(e.contents.splitlines())))
+        db.execute("UPDATE changes SET seq = ?", (seq,))
+        profiling.count("entries written", len(entries))
+
+    @logfile.exclusive
+    def import_entries(self, entries):
+        """
+        Merge many entries into the log. Entries with the same date and mark,
+        both among the new ones and in the log, are merged the same way 'add'
+        merges them.
+        """
+        incoming = {}
+        for e in entries:
+            key = (e.date, e.mark)
+            if key in incoming:
+                incoming[key].merge(e)
+            else:
+                incoming[key] = e
+        merged = []
+        for (date, mark), e in incoming.items():
+            old = self.find_specific(date, mark)
+            if old is not None:
+                old.merge(e)
+                e = old
+            merged.append(e)
+        with transaction(self.connect()):
+            self.put_many(merged)
+
+    #--------- removing entries from the log ---------#
+
+    @logfile.exclusive
+    def remove(self, date, mark):
+        """ Remove specific entry from the log """
+        with transaction(self.connect()):
+            self.delete_many([(date.isoformat(), mark)])
+
+    @logfile.exclusive
+    def remove_several(self, predicate, before=None, after=None, mark=None):
+        """
+        Remove all entries such that predicate(entry) is True. If 'mark' is
+        not None, only entries with this mark are considered.
+        """
+        doomed = [(e.date.isoformat(), e.mark)
+                for e in self.filter_entries(predicate, before, after, mark)]
+        with transaction(self.connect()):
+            self.delete_many(doomed)
+
+    def delete_many(self, keys):
+        """ Remove entries with given dates and marks, inside a transaction """
+        db = self.connect()
+        seq = last_seq(db)
+        for date, mark in keys:
+            row = db.execute("SELECT rowid FROM entries WHERE date = ? AND mark = ?",
+                    (date, mark)).fetchone()
+            if row is None:
+                continue
+            seq += 1
+            db.execute("DELETE FROM entries WHERE rowid = ?", row)
+            if self.full_text:
+                db.execute("DELETE FROM entries_fts WHERE rowid = ?", row)
+        db.execute("UPDATE changes SET seq = ?", (seq,))
+
+    #--------- maintenance ---------#
+
+    @logfile.exclusive
+    def compact(self):
+        """ Move the write-ahead log into the database and tidy up the indices """
+        db = self.connect()
+        if self.full_text:
+            db.execute("INSERT INTO entries_fts (entries_fts) VALUES ('optimize')")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def migrate(self):
+        """ Do nothing: the database has a single format """
+
+    def version(self):
+        """ Return None, as the database isn't versioned like the log file """
+        return None
+
+    #--------- querying entries ---------#
+
+    def merged_entries(self, before=None, after=None, mark=None, reverse=False):
+        """
+        Return an iterator of all the entries, from the latest to the oldest,
+        or in reverse order if 'reverse' is True
+        """
+        where, params = conditions(before, after, mark)
+        order = "ASC" if reverse else "DESC"
+        rows = self.connect().execute(f"""SELECT date, mark, contents FROM entries
+                {where} ORDER BY date {order}, rowid {order}""", params)
+        return rows_entries(rows)
+
+    def grep(self, pattern, before=None, after=None, mark=None, reverse=False,
+            jobs=1):
+        """
+        Return an iterator with all entries matching given search.Pattern. If
+        the pattern requires some literal strings of three or more characters
+        to be present in the matches, only the candidates found by the
+        full-text index are checked.
+        """
+        matches = profiling.timed("regex matching")(pattern.matches)
+        where, params = conditions(before, after, mark)
+        order = "ASC" if reverse else "DESC"
+        phrases = [literal for literal in pattern.literals if len(literal) >= 3]
+        if self.full_text and phrases:
+            query = " AND ".join('"' + p.replace('"', '""') + '"' for p in phrases)
+            where = ("WHERE " if not where else where + " AND ") + """rowid IN
+                    (SELECT rowid FROM entries_fts WHERE entries_fts MATCH ?)"""
+            params.append(query)
+        rows = self.connect().execute(f"""SELECT date, mark, contents FROM entries
+                {where} ORDER BY date {order}, rowid {order}""", params)
+        for e in rows_entries(rows):
+            if matches(e.contents):
+                profiling.count("entries matched")
+                yield e
+
+    def mark_catalog(self):
+        """
+        Return a dict mapping every mark in the log to a triple of the number
+        of entries with this mark and the dates of the oldest and the latest
+        of them
+        """
+        rows = self.connect().execute("""SELECT mark, count(*), min(date), max(date)
+                FROM entries GROUP BY mark""")
+        return {mark: (count, datetime.date.fromisoformat(oldest),
+                datetime.date.fromisoformat(latest))
+                for mark, count, oldest, latest in rows}
+
+    def find_specific(self, date, mark=""):
+        """
+        Return an entry with given date and mark, or None if such an entry does
+        not exist.
+        """
+        row = self.connect().execute("""SELECT date, mark, contents FROM entries
+                WHERE date = ? AND mark = ?""", (date.isoformat(), mark)).fetchone()
+        return next(rows_entries([row]), None) if row is not None else None
+
+    def changes_since(self, seq, mark=None):
+        """
+        Return a pair of the list of the entries added or changed after the
+        change with given number, optionally only the ones with given mark,
+        and the number of the latest change. Removals are numbered too, so
+        they advance the number without adding any entries.
+        """
+        db = self.connect()
+        # the latest change is read first, so that the changes made in
+        # between are left for the next call
+        latest = last_seq(db)
+        where, params = "WHERE seq > ? AND seq <= ?", [seq, latest]
+        if mark is not None:
+            where += " AND mark = ?"
+            params.append(mark)
+        rows = db.execute(f"""SELECT date, mark, contents FROM entries {where}
+                ORDER BY seq""", params).fetchall()
+        return list(rows_entries(rows)), latest
+
+#--------- helper functions ---------#
+
+@contextlib.contextmanager
+def transaction(db):
+    """ Run a 'with' block in a write transaction """
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+def last_seq(db):
+    """ Return the number of the latest change """
+    seq, = db.execute("SELECT seq FROM changes").fetchone()
+    return seq
+
+def conditions(before, after, mark):
+    """ Return a WHERE clause with its parameters selecting entries """
+    clauses, params = [], []
+    if before is not None:
+        clauses.append("date < ?")
+        params.append(before.isoformat())
+    if after is not None:
+        clauses.append("date > ?")
+        params.append(after.isoformat())
+    if mark is not None:
+        clauses.append("mark = ?")
+        params.append(mark)
+    return ("WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+def rows_entries(rows):
+    """ Return an iterator of entries made of rows of the entries table """
+    read = 0
+    try:
+        for date, mark, contents in rows:
+            read += 1
+            yield entry.Entry(contents, datetime.date.fromisoformat(date), mark)
+    finally:
+        profiling.count("entries read", read)
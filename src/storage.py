@@ -0,0 +1,112 @@
+""" A module for the interface shared by the ways of storing the log """
+
+# ways of storing the log: a binary log file, possibly split into shards, or an
+# SQLite database
+BACKENDS = ["binary", "sqlite"]
+
+class Storage():
+    """
+    The base of the classes storing the log: Logfile, ShardedLog and
+    SqliteLog. A subclass provides:
+
+    - merged_entries(before, after, mark, reverse), grep(pattern, before,
+      after, mark, reverse, jobs), find_specific(date, mark) and
+      mark_catalog() for querying, 'pattern' being a search.Pattern;
+    - prepend(e), insert_by_date(e), replace(e), remove(date, mark),
+      remove_several(predicate, before, after, mark) and
+      import_entries(entries) for changing the log;
+    - ensure_existence(), recover(), compact(), migrate(), version() and
+      keep_in_memory() for maintenance;
+    - load(entries), which replaces everything stored with given entries, and
+      destroy(), which removes all the files of the log, for conversions
+      between the backends;
+    - segments() and files(), the parts of the log 'follow' command tracks
+      and the files it watches;
+    - 'path', the path of the log without any suffixes, and 'lock', the lock
+      on the log.
+
+    The rest of the queries are derived here.
+    """
+
+    def filter_entries(self, predicate, before=None, after=None, mark=None):
+        """
+        Return an iterator of entries such that predicate(entry) is True. If
+        'mark' is not None, only entries with this mark are considered.
+        """
+        for e in self.merged_entries(before, after, mark):
+            if predicate(e):
+                yield e
+
+    def all_entries(self, before=None, after=None, reverse=False):
+        """ Return all the entries in the log """
+        return self.merged_entries(before, after, None, reverse)
+
+    def marked_entries(self, mark, before=None, after=None, reverse=False):
+        """ Return all the entries with given mark """
+        return self.merged_entries(before, after, mark, reverse)
+
+    def grep_marked(self, pattern, mark, before=None, after=None, reverse=False,
+            jobs=1):
+        """ Return an iterator with all entries with given mark matching given pattern """
+        return self.grep(pattern, before, after, mark, reverse, jobs)
+
+    def last_entry(self):
+        """ Return the latest entry, or None if the log is empty """
+        return next(self.merged_entries(), None)
+
+#--------- choosing and converting the backends ---------#
+
+def open_log(path, backend="binary", sharding="none", durability="always",
+        compress=False):
+    """ Return the log at given path, stored the given way """
+    if backend == "sqlite":
+        import sqlitelog
+        return sqlitelog.SqliteLog(path, durability, compress)
+    if sharding != "none":
+        import shards
+        return shards.ShardedLog(path, sharding, durability, compress)
+    import logfile
+    return logfile.Logfile(path, durability, compress)
+
+def existing(path, durability="always", compress=False):
+    """
+    Return the log at given path, stored the way it is stored on disk at the
+    moment, or None if there's no log yet
+    """
+    if path.with_name(path.name + ".db").exists():
+        return open_log(path, "sqlite", durability=durability, compress=compress)
+    manifest = path.with_name(path.name + ".manifest")
+    if manifest.exists():
+        import shards
+        return open_log(path, sharding=shards.manifest_period(manifest),
+                durability=durability, compress=compress)
+    if path.exists():
+        return open_log(path, durability=durability, compress=compress)
+    return None
+
+def adopt(log):
+    """
+    Convert the log stored some other way into given log, if it is stored
+    some other way. This is done on the first run after the way of storing
+    the log is changed in the configuration.
+
+    The old files are only removed once the new ones are complete. Should
+    the process die in between, the new files are either ignored or written
+    anew on the next run.
+    """
+    old = existing(log.path, log.durability, log.compress)
+    if old is None or same_kind(old, log):
+        return
+    with log.lock.held(exclusive=True):
+        # another process may have converted the log in the meantime
+        old = existing(log.path, log.durability, log.compress)
+        if old is None or same_kind(old, log):
+            return
+        old.lock = log.lock
+        log.load(old.all_entries())
+        old.destroy()
+
+def same_kind(log1, log2):
+    """ Return whether two logs are stored the same way """
+    return (type(log1) is type(log2)
+            and getattr(log1, "period", None) == getattr(log2, "period", None))
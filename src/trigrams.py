@@ -0,0 +1,198 @@
+""" A module for the trigram index of the entries' contents """
+
+import array
+import bisect
+import re
+import struct
+
+import fsutil
+import profiling
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# a trigram index file starts with this signature, followed by a stamp of the
+# log's state, just like the offset index
+MAGIC = b"SIMLOGT1"
+STAMP = struct.Struct("=8sQQ")
+COUNT = struct.Struct("=Q")
+# a posting list header: trigram's length in bytes and number of entries,
+# followed by the trigram and the entries' positions
+POSTING = struct.Struct("=HQ")
+
+class TrigramIndex():
+    """
+    An inverted index mapping every three-character substring of the entries'
+    contents to the list of positions of entries containing it. Positions are
+    numbers of the entries in the log file, from the latest to the oldest, the
+    same as the positions in the offset index.
+
+    The contents are indexed in the same form 'grep' matches them against, with
+    the lines joined by spaces.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.postings = {}
+        self.size = 0
+
+    #--------- persistence ---------#
+
+    def exists(self):
+        """ Return whether the index was ever built """
+        return self.path.exists()
+
+    def load(self, stamp):
+        """
+        Load the index from disk. Return False if there's no index or if it
+        was built for a different state of the log.
+        """
+        if self.stamp == stamp:
+            return True
+        try:
+            with self.path.open("rb") as f:
+                data = f.read()
+            profiling.count("bytes read", len(data))
+        except FileNotFoundError:
+            return False
+        head_size = STAMP.size + 2 * COUNT.size
+        if len(data) < head_size or STAMP.unpack_from(data, 0) != (MAGIC, *stamp):
+            return False
+        size, = COUNT.unpack_from(data, STAMP.size)
+        count, = COUNT.unpack_from(data, STAMP.size + COUNT.size)
+        pos = head_size
+        postings = {}
+        try:
+            for _ in range(count):
+                key_len, n = POSTING.unpack_from(data, pos)
+                pos += POSTING.size
+                gram = data[pos : pos + key_len].decode("utf-8")
+                pos += key_len
+                positions = array.array("I")
+                positions.frombytes(data[pos : pos + n * positions.itemsize])
+                pos += n * positions.itemsize
+                postings[gram] = positions
+        except (struct.error, UnicodeDecodeError, ValueError):
+            return False
+        self.postings, self.size, self.stamp = postings, size, stamp
+        return True
+
+    def save(self, stamp):
+        """ Write the index to disk, marking it as built for given log state """
+        chunks = [STAMP.pack(MAGIC, *stamp), COUNT.pack(self.size),
+                COUNT.pack(len(self.postings))]
+        for gram, positions in self.postings.items():
+            key = bytes(gram, "utf-8")
+            chunks.append(POSTING.pack(len(key), len(positions)))
+            chunks.append(key)
+            chunks.append(positions.tobytes())
+        data = b"".join(chunks)
+        fsutil.replace_file(self.path, lambda f: f.write(data), sync=False)
+        self.stamp = stamp
+
+    def drop(self):
+        """ Remove the index, so that it is built anew when it's needed """
+        if self.path.exists():
+            self.path.unlink()
+        self.postings, self.size, self.stamp = {}, 0, None
+
+    #--------- modification ---------#
+
+    def rebuild(self, contents):
+        """ Replace the index with one built from given entries' contents """
+        postings = {}
+        size = 0
+        for pos, text in enumerate(contents):
+            for gram in trigrams(searchable(text)):
+                positions = postings.get(gram)
+                if positions is None:
+                    positions = postings[gram] = array.array("I")
+                positions.append(pos)
+            size += 1
+        self.postings, self.size, self.stamp = postings, size, None
+
+    def update(self, pos, old, new):
+        """
+        Replace the contents of the entry at given position, 'old', with the
+        'new' ones
+        """
+        old_grams, new_grams = trigrams(searchable(old)), trigrams(searchable(new))
+        for gram in old_grams - new_grams:
+            positions = self.postings[gram]
+            positions.remove(pos)
+            if not positions:
+                del self.postings[gram]
+        for gram in new_grams - old_grams:
+            positions = self.postings.get(gram)
+            if positions is None:
+                positions = self.postings[gram] = array.array("I")
+            bisect.insort(positions, pos)
+        self.stamp = None
+
+    #--------- lookup ---------#
+
+    def candidates(self, literals):
+        """
+        Return a sorted list of positions of the entries containing all of
+        given strings, or None if the strings are too short for the index to
+        narrow the search down.
+        """
+        grams = set()
+        for literal in literals:
+            grams |= trigrams(literal)
+        if not grams:
+            return None
+        found = None
+        for gram in sorted(grams, key=lambda g: len(self.postings.get(g, ()))):
+            positions = self.postings.get(gram)
+            if positions is None:
+                return []
+            found = set(positions) if found is None else found.intersection(positions)
+            if not found:
+                return []
+        return sorted(found)
+
+#--------- helper functions ---------#
+
+def searchable(contents):
+    """ Return the contents with the lines joined, as 'grep' sees them """
+    return " ".join(contents.splitlines())
+
+def trigrams(text):
+    """ Return a set of all three-character substrings of a string """
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+def required_literals(regex):
+    """
+    Return a list of strings that must occur in any string matched by given
+    compiled regex. The list may be incomplete, and it is empty if nothing can
+    be said about the matches.
+    """
+    if regex.flags & re.IGNORECASE:
+        return []
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except (re.error, TypeError):
+        return []
+    if parsed.state.flags & re.IGNORECASE:
+        return []
+    literals = []
+    run = []
+    def flush():
+        if run:
+            literals.append("".join(run))
+            run.clear()
+    def scan(items):
+        for op, arg in items:
+            if op is sre_parse.LITERAL:
+                run.append(chr(arg))
+            elif op is sre_parse.SUBPATTERN and not arg[1] & re.IGNORECASE:
+                scan(arg[3])
+            else:
+                flush()
+    scan(parsed)
+    flush()
+    return literals
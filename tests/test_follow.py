@@ -0,0 +1,93 @@
+""" Tests of following the changes of the log """
+
+import datetime
+import pathlib
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import entry
+import follow
+import logfile
+import sqlitelog
+
+DAY = datetime.date(2020, 1, 1)
+
+class FollowerTest():
+    """ Tests of follow.Follower, run on every kind of log below """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = self.make_log(pathlib.Path(self.tmp.name) / "log")
+        self.log.ensure_existence()
+        self.add("a", "a")
+        self.follower = follow.Follower(self.log)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add(self, contents, mark):
+        self.log.replace(entry.Entry(contents, DAY, mark))
+
+    def contents(self):
+        return [e.contents for e in self.follower.changes()]
+
+    def test_add(self):
+        self.add("b", "b")
+        self.assertEqual(self.contents(), ["b"])
+        self.assertEqual(self.contents(), [])
+
+    def test_remove_latest_then_add(self):
+        self.add("b", "b")
+        self.assertEqual(self.contents(), ["b"])
+        self.log.remove(DAY, "b")
+        self.assertEqual(self.contents(), [])
+        self.add("c", "c")
+        self.assertEqual(self.contents(), ["c"])
+
+    def test_remove_latest_and_add(self):
+        self.add("b", "b")
+        self.assertEqual(self.contents(), ["b"])
+        self.log.remove(DAY, "b")
+        self.add("c", "c")
+        self.assertEqual(self.contents(), ["c"])
+
+    def test_remove_then_add_again(self):
+        self.log.remove(DAY, "a")
+        self.assertEqual(self.contents(), [])
+        self.add("a", "a")
+        self.assertEqual(self.contents(), ["a"])
+
+class LogfileFollowerTest(FollowerTest, unittest.TestCase):
+    """ Tests of following the binary log """
+
+    def make_log(self, path):
+        return logfile.Logfile(path)
+
+    def test_splice_is_seen(self):
+        self.log.compact()
+        self.assertEqual(self.contents(), [])
+        self.assertTrue(self.log.splice(entry.Entry("b", DAY, "a")))
+        self.assertEqual(self.contents(), ["b"])
+        self.assertEqual(self.contents(), [])
+
+class SqliteFollowerTest(FollowerTest, unittest.TestCase):
+    """ Tests of following the SQLite log """
+
+    def make_log(self, path):
+        return sqlitelog.SqliteLog(path)
+
+    def tearDown(self):
+        self.log.close()
+        super().tearDown()
+
+    def test_removal_is_seen(self):
+        seq = self.follower.segments[self.log.path].seq
+        self.log.remove(DAY, "a")
+        self.assertEqual(self.contents(), [])
+        self.assertGreater(self.follower.segments[self.log.path].seq, seq)
+
+if __name__ == "__main__":
+    unittest.main()
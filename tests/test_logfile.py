@@ -0,0 +1,181 @@
+""" Tests of the binary log """
+
+import datetime
+import os
+import pathlib
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import entry
+import logfile
+import search
+
+DAY = datetime.date(2020, 1, 1)
+
+class LogfileTest(unittest.TestCase):
+    """ A base of the tests, with a log in a temporary directory """
+
+    version = 2
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name) / "log"
+        self.log = logfile.Logfile(self.path)
+        self.log.ensure_existence()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, *entries):
+        """ Rewrite the log file with (contents, date, mark) triples """
+        self.log.rewrite([entry.Entry(*t) for t in entries], self.version)
+
+    def contents(self, entries):
+        return [e.contents for e in entries]
+
+class SpliceTest(LogfileTest):
+    """ Tests of replacing entries by overwriting their records in place """
+
+    def setUp(self):
+        super().setUp()
+        self.write(("foo one", DAY, "a"), ("bar one", DAY, "b"))
+
+    def test_in_place(self):
+        size = self.path.stat().st_size
+        self.log.replace(entry.Entry("bar two", DAY, "b"))
+        self.assertEqual(self.path.stat().st_size, size)
+        self.assertEqual(self.log.delta.load(), {})
+        self.assertEqual(self.contents(self.log.all_entries()), ["foo one", "bar two"])
+
+    def test_found_entry_outlives_splice(self):
+        found = self.log.find_specific(DAY, "b")
+        other = logfile.Logfile(self.path)
+        other.replace(entry.Entry("baz two", DAY, "b"))
+        self.assertEqual(found.contents, "bar one")
+        self.assertEqual(self.log.find_specific(DAY, "b").contents, "baz two")
+
+    def test_stamp_changes(self):
+        stamp = self.log.stamp()
+        self.log.replace(entry.Entry("bar two", DAY, "b"))
+        self.assertNotEqual(self.log.stamp(), stamp)
+
+    def test_cache_dropped(self):
+        pattern = search.Pattern("bar", False, False)
+        self.assertEqual(self.contents(self.log.grep(pattern)), ["bar one"])
+        st = self.path.stat()
+        self.log.replace(entry.Entry("baz two", DAY, "b"))
+        # a file system keeping coarse times may leave the stamp as it was
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertEqual(self.contents(self.log.grep(pattern)), [])
+
+class ImportTest(LogfileTest):
+    """ Tests of importing entries """
+
+    def setUp(self):
+        super().setUp()
+        self.write(("a", DAY + datetime.timedelta(days=1), "a"), ("b", DAY, "b"))
+
+    def test_same_day_ahead(self):
+        self.log.import_entries([entry.Entry("c", DAY, "c")])
+        self.assertEqual(self.contents(self.log.all_entries()), ["a", "c", "b"])
+
+    def test_like_add(self):
+        new = [("c", DAY, "c"), ("d", DAY, "d"), ("e", DAY - datetime.timedelta(days=1), "")]
+        added = logfile.Logfile(pathlib.Path(self.tmp.name) / "added")
+        added.ensure_existence()
+        added.rewrite(self.log.all_entries(), self.version)
+        for t in new:
+            added.insert_by_date(entry.Entry(*t))
+        self.log.import_entries([entry.Entry(*t) for t in new])
+        self.assertEqual(self.contents(self.log.all_entries()),
+                self.contents(added.all_entries()))
+
+    def test_merged_once(self):
+        self.log.import_entries([entry.Entry("b2", DAY, "b"), entry.Entry("c", DAY, "c")])
+        self.assertEqual(self.contents(self.log.all_entries()), ["a", "c", "b\nb2"])
+
+class DeltaTest(LogfileTest):
+    """ Tests of the order of the entries with changes in the delta log """
+
+    def setUp(self):
+        super().setUp()
+        self.log.durability = "batched"
+        self.write(("a", DAY + datetime.timedelta(days=1), "a"), ("b", DAY, "b"),
+                ("c", DAY, "c"))
+
+    def test_replace_keeps_place(self):
+        self.log.replace(entry.Entry("b two", DAY, "b"))
+        self.assertIn((DAY, "b"), self.log.delta.load())
+        self.assertEqual(self.contents(self.log.all_entries()), ["a", "b two", "c"])
+
+    def test_new_ahead_of_day(self):
+        self.log.insert_by_date(entry.Entry("d", DAY, "d"))
+        self.log.prepend(entry.Entry("e", DAY + datetime.timedelta(days=2), "e"))
+        self.assertEqual(self.contents(self.log.all_entries()), ["e", "a", "d", "b", "c"])
+
+    def test_removed_then_added_is_new(self):
+        self.log.remove(DAY, "c")
+        self.log.insert_by_date(entry.Entry("c two", DAY, "c"))
+        self.assertEqual(self.contents(self.log.all_entries()), ["a", "c two", "b"])
+
+    def test_reverse(self):
+        self.log.insert_by_date(entry.Entry("d", DAY, "d"))
+        self.log.replace(entry.Entry("b two", DAY, "b"))
+        self.assertEqual(self.contents(self.log.all_entries(reverse=True)),
+                ["c", "b two", "d", "a"])
+
+    def test_interval(self):
+        self.log.insert_by_date(entry.Entry("d", DAY, "d"))
+        after = DAY - datetime.timedelta(days=1)
+        before = DAY + datetime.timedelta(days=1)
+        self.assertEqual(self.contents(self.log.all_entries(before, after)),
+                ["d", "b", "c"])
+
+    def test_compact_keeps_order(self):
+        self.log.insert_by_date(entry.Entry("d", DAY, "d"))
+        self.log.replace(entry.Entry("b two", DAY, "b"))
+        self.log.remove(DAY, "c")
+        merged = self.contents(self.log.all_entries())
+        self.log.compact()
+        self.assertEqual(self.log.delta.load(), {})
+        self.assertEqual(self.contents(self.log.all_entries()), merged)
+
+class FormatTest(LogfileTest):
+    """ Tests of reading and converting the older layout of the log file """
+
+    version = 1
+
+    def setUp(self):
+        super().setUp()
+        self.write(("a", DAY + datetime.timedelta(days=1), "a"), ("b", DAY, "b"),
+                ("c", DAY, ""))
+
+    def test_read(self):
+        self.assertEqual(self.log.version(), 1)
+        self.assertEqual(self.contents(self.log.all_entries()), ["a", "b", "c"])
+        self.assertEqual(self.log.find_specific(DAY, "b").contents, "b")
+        self.assertEqual(self.contents(self.log.marked_entries("a")), ["a"])
+
+    def test_changes_keep_layout(self):
+        self.log.replace(entry.Entry("b two", DAY, "b"))
+        self.log.remove(DAY, "")
+        self.log.compact()
+        self.assertEqual(self.log.version(), 1)
+        self.assertEqual(self.contents(self.log.all_entries()), ["a", "b two"])
+
+    def test_migrate(self):
+        self.log.replace(entry.Entry("b two", DAY, "b"))
+        self.log.migrate()
+        self.assertEqual(self.log.version(), 2)
+        self.assertEqual(self.contents(self.log.all_entries()), ["a", "b two", "c"])
+
+class V1SpliceTest(SpliceTest):
+    """ Tests of replacing entries in place in the older layout """
+
+    version = 1
+
+if __name__ == "__main__":
+    unittest.main()
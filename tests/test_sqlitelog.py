@@ -0,0 +1,128 @@
+""" Tests of the SQLite log """
+
+import datetime
+import pathlib
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "src"))
+
+import entry
+import logfile
+import sqlitelog
+import storage
+
+DAY = datetime.date(2020, 1, 1)
+
+class ChangesSinceTest(unittest.TestCase):
+    """ Tests of SqliteLog.changes_since """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = sqlitelog.SqliteLog(pathlib.Path(self.tmp.name) / "log")
+        self.log.ensure_existence()
+
+    def tearDown(self):
+        self.log.close()
+        self.tmp.cleanup()
+
+    def add(self, contents, mark):
+        self.log.replace(entry.Entry(contents, DAY, mark))
+
+    def test_remove_then_add(self):
+        self.add("a", "a")
+        self.add("b", "b")
+        _, seq = self.log.changes_since(0)
+        self.log.remove(DAY, "b")
+        self.add("c", "c")
+        changed, _ = self.log.changes_since(seq)
+        self.assertEqual([e.contents for e in changed], ["c"])
+
+    def test_removal_advances_number(self):
+        self.add("a", "a")
+        _, seq = self.log.changes_since(0)
+        self.log.remove(DAY, "a")
+        changed, after = self.log.changes_since(seq)
+        self.assertEqual(changed, [])
+        self.assertGreater(after, seq)
+
+    def test_load_keeps_numbering(self):
+        self.add("a", "a")
+        _, seq = self.log.changes_since(0)
+        self.log.load([entry.Entry("b", DAY, "b")])
+        changed, _ = self.log.changes_since(seq)
+        self.assertEqual([e.contents for e in changed], ["b"])
+
+class OrderTest(unittest.TestCase):
+    """ Tests of the order of the entries made on the same day """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name) / "log"
+        self.log = sqlitelog.SqliteLog(self.path)
+        self.log.ensure_existence()
+        for mark in "bac":
+            self.log.replace(entry.Entry(mark, DAY, mark))
+
+    def tearDown(self):
+        self.log.close()
+        self.tmp.cleanup()
+
+    def contents(self, log, reverse=False):
+        return "".join(e.contents for e in log.all_entries(reverse=reverse))
+
+    def test_latest_added_first(self):
+        self.assertEqual(self.contents(self.log), "cab")
+        self.assertEqual(self.contents(self.log, True), "bac")
+
+    def test_replace_keeps_place(self):
+        self.log.replace(entry.Entry("a", DAY, "a"))
+        self.assertEqual(self.contents(self.log), "cab")
+
+    def test_conversions_keep_order(self):
+        binary = logfile.Logfile(self.path)
+        storage.adopt(binary)
+        self.assertEqual(self.contents(binary), "cab")
+        back = sqlitelog.SqliteLog(self.path)
+        storage.adopt(back)
+        self.assertEqual(self.contents(back), "cab")
+        back.close()
+
+class ConversionTest(unittest.TestCase):
+    """ Tests of converting a binary log into an SQLite one """
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.tmp.name) / "log"
+        old = logfile.Logfile(self.path)
+        old.ensure_existence()
+        for mark in "abc":
+            old.replace(entry.Entry(mark, DAY, mark))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_interrupted(self):
+        def interrupted(log, *args):
+            yield entry.Entry("a", DAY, "a")
+            raise KeyboardInterrupt()
+        log = sqlitelog.SqliteLog(self.path)
+        with unittest.mock.patch.object(logfile.Logfile, "all_entries", interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                storage.adopt(log)
+        log.close()
+        old = storage.existing(self.path)
+        self.assertIsInstance(old, logfile.Logfile)
+        self.assertEqual(sorted(e.contents for e in old.all_entries()), ["a", "b", "c"])
+
+    def test_complete(self):
+        log = sqlitelog.SqliteLog(self.path)
+        storage.adopt(log)
+        self.assertEqual(sorted(e.contents for e in log.all_entries()), ["a", "b", "c"])
+        self.assertFalse(self.path.exists())
+        log.close()
+
+if __name__ == "__main__":
+    unittest.main()